@@ -17,6 +17,11 @@ from botbuilder.core.integration import aiohttp_error_middleware
 from botbuilder.schema import Activity, ActivityTypes
 
 from bot import MyBot, logging
+from common.admission import AdmissionController, AdmissionRejected
+from common.chains import CHAIN_REGISTRY
+from common.prompts import BUSY_MESSAGE
+from common.tracing import METRICS, setup_opentelemetry
+from common.utils import close_aiohttp_session, search_cache_stats
 from config import DefaultConfig
 
 CONFIG = DefaultConfig()
@@ -60,6 +65,25 @@ ADAPTER.on_turn_error = on_error
 # Create the Bot
 BOT = MyBot()
 
+# Bounds the turns running at once, a burst is queued for a while and then shed with a busy reply
+ADMISSION = AdmissionController.from_env()
+
+# Build the chains and prepare the history container once per process so turns only pass their own config
+CHAIN_REGISTRY.warm()
+BOT.history_store.prepare()
+
+# Stage latencies are always aggregated for /metrics, spans are also exported when OTEL_EXPORTER_OTLP_ENDPOINT is set
+setup_opentelemetry()
+METRICS.add_collector("search_cache", search_cache_stats)
+METRICS.add_collector("admission", ADMISSION.stats)
+METRICS.add_collector("history", BOT.history_store.stats)
+if BOT.answer_cache is not None:
+    METRICS.add_collector("answer_cache", BOT.answer_cache.stats)
+
+
+async def send_busy_reply(turn_context: TurnContext) -> None:
+    await turn_context.send_activity(BUSY_MESSAGE)
+
 
 # Listen for incoming requests on /api/messages
 async def messages(req: Request) -> Response:
@@ -72,7 +96,16 @@ async def messages(req: Request) -> Response:
     activity = Activity().deserialize(body)
     auth_header = req.headers["Authorization"] if "Authorization" in req.headers else ""
 
-    response = await ADAPTER.process_activity(activity, auth_header, BOT.on_turn)
+    if activity.type == ActivityTypes.message:
+        user_id = activity.from_property.id + "-" + activity.channel_id
+        try:
+            async with ADMISSION.admit(user_id, activity.conversation.id):
+                response = await ADAPTER.process_activity(activity, auth_header, BOT.on_turn)
+        except AdmissionRejected as e:
+            logging.warning(f"{e}, user {user_id} gets a busy reply")
+            response = await ADAPTER.process_activity(activity, auth_header, send_busy_reply)
+    else:
+        response = await ADAPTER.process_activity(activity, auth_header, BOT.on_turn)
     if response:
         return json_response(data=response.body, status=response.status)
     return Response(status=201)
@@ -80,10 +113,22 @@ async def messages(req: Request) -> Response:
 async def healthcheck(req: Request) -> Response:
     return Response(text= "OK", status=200)
 
+# Prometheus scrape endpoint
+async def metrics(req: Request) -> Response:
+    return Response(text=METRICS.render(), content_type="text/plain")
+
+
+# Flush the pending history writes and close the pooled HTTP sessions when the worker stops
+async def on_cleanup(app: web.Application) -> None:
+    await BOT.history_store.aclose()
+    await close_aiohttp_session()
+
 
 APP = web.Application(middlewares=[aiohttp_error_middleware])
 APP.router.add_post("/api/messages", messages)
 APP.router.add_get("/", healthcheck)
+APP.router.add_get("/metrics", metrics)
+APP.on_cleanup.append(on_cleanup)
 
 if __name__ == "__main__":
     try:
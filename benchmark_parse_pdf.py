@@ -0,0 +1,124 @@
+"""Benchmark of the Document Intelligence page assembly of parse_pdf.
+
+Builds a synthetic analysis result (pages with tables, like a long contract) and times
+common.utils.build_form_recognizer_page_map against the previous character by character
+implementation, after checking that both produce the same page_map.
+
+    python benchmark_parse_pdf.py --pages 500 --tables-per-page 3
+"""
+import html
+import time
+import random
+import argparse
+
+from types import SimpleNamespace
+
+from common.utils import build_form_recognizer_page_map
+
+
+def previous_table_to_html(table):
+    table_html = "<table>"
+    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    for row_cells in rows:
+        table_html += "<tr>"
+        for cell in row_cells:
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+        table_html +="</tr>"
+    table_html += "</table>"
+    return table_html
+
+
+def previous_page_map(form_recognizer_results, offset=0):
+    page_map = []
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
+
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        table_chars = [-1]*page_length
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                for i in range(span.length):
+                    idx = span.offset - page_offset + i
+                    if idx >=0 and idx < page_length:
+                        table_chars[idx] = table_id
+
+        page_text = ""
+        added_tables = set()
+        for idx, table_id in enumerate(table_chars):
+            if table_id == -1:
+                page_text += form_recognizer_results.content[page_offset + idx]
+            elif not table_id in added_tables:
+                page_text += previous_table_to_html(tables_on_page[table_id])
+                added_tables.add(table_id)
+
+        page_text += " "
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+    return page_map
+
+
+def synthetic_result(pages: int, tables_per_page: int, page_chars: int, rows: int, columns: int, seed: int = 0):
+    """Analysis result shaped like the Document Intelligence one, with overlapping and out of page table spans"""
+    rng = random.Random(seed)
+    words = "the parties agree that the supplier shall deliver <goods> & services as set out in schedule".split()
+    content_parts, page_objects, tables = [], [], []
+    position = 0
+    for page_num in range(pages):
+        text = ""
+        while len(text) < page_chars:
+            text += rng.choice(words) + rng.choice([" ", " ", "\n"])
+        text = text[:page_chars]
+        content_parts.append(text)
+        page_objects.append(SimpleNamespace(spans=[SimpleNamespace(offset=position, length=page_chars)]))
+        for _ in range(tables_per_page):
+            start = position + rng.randrange(-20, page_chars)
+            spans = [SimpleNamespace(offset=start, length=rng.randrange(50, 400))]
+            if rng.random() < 0.3:
+                spans.append(SimpleNamespace(offset=start + rng.randrange(0, 600), length=rng.randrange(10, 100)))
+            cells = [SimpleNamespace(row_index=r, column_index=c, kind="columnHeader" if r == 0 else "content",
+                                     column_span=rng.choice([1, 1, 1, 2]), row_span=1,
+                                     content=" ".join(rng.choice(words) for _ in range(3)))
+                     for r in range(rows) for c in range(columns)]
+            rng.shuffle(cells)
+            tables.append(SimpleNamespace(bounding_regions=[SimpleNamespace(page_number=page_num + 1)],
+                                          spans=spans, cells=cells, row_count=rows))
+        position += page_chars
+    return SimpleNamespace(content="".join(content_parts), pages=page_objects, tables=tables)
+
+
+def best_of(function, result, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(result)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--tables-per-page", type=int, default=3)
+    parser.add_argument("--page-chars", type=int, default=3000)
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--columns", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    result = synthetic_result(args.pages, args.tables_per_page, args.page_chars, args.rows, args.columns)
+    if build_form_recognizer_page_map(result) != previous_page_map(result):
+        raise SystemExit("page_map differs from the previous implementation")
+
+    previous = best_of(previous_page_map, result, args.repeat)
+    current = best_of(build_form_recognizer_page_map, result, args.repeat)
+    print(f"{args.pages} pages, {len(result.tables)} tables of {args.rows}x{args.columns} cells: identical page_map")
+    print(f"previous: {previous:.3f}s  current: {current:.3f}s  speedup: {previous / current:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
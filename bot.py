@@ -3,21 +3,18 @@
 import os
 import time
 
-from operator import itemgetter
 from typing import Any, Dict, List, Optional, Union
 
-from langchain_openai import AzureChatOpenAI
-from langchain_core.runnables import ConfigurableFieldSpec
-from langchain_community.chat_message_histories import CosmosDBChatMessageHistory
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.callbacks.manager import CallbackManager
+from langchain.callbacks.base import AsyncCallbackHandler
 from langchain.schema import AgentAction
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.output_parsers import StrOutputParser
-from common.utils import CustomAzureSearchRetriever
-from common.prompts import WELCOME_MESSAGE, DOCSEARCH_PROMPT
-
-from botbuilder.core import ActivityHandler, TurnContext
+from common.chains import CHAIN_REGISTRY, DOCSEARCH_CHAIN, build_docsearch_chain
+from common.history import CosmosDBHistoryStore, CachedChatMessageHistory
+from common.semantic_cache import SemanticAnswerCache
+from common.utils import METADATA_SEPARATOR
+from common.prompts import WELCOME_MESSAGE
+from common.tracing import span
+
+from botbuilder.core import ActivityHandler, MessageFactory, TurnContext
 from botbuilder.schema import ChannelAccount, Activity, ActivityTypes
 
 from dotenv import load_dotenv
@@ -30,9 +27,17 @@ logging.basicConfig(level=logging.WARNING, filename='app.log', format='%(asctime
 # Env variables needed by langchain
 os.environ["OPENAI_API_VERSION"] = os.environ.get("AZURE_OPENAI_API_VERSION")
 
+# Streaming of partial answers to the channel: "auto", "update", "chunked" or "off"
+STREAMING_MODE = os.environ.get("BOT_STREAMING_MODE", "auto")
+# Channels that support editing an activity already sent (used by the "auto" mode)
+STREAMING_UPDATE_CHANNELS = set(os.environ.get("BOT_STREAMING_UPDATE_CHANNELS", "msteams,slack").split(","))
+# Coalescing window: tokens are flushed to the channel every N seconds or every N characters, whichever comes first
+STREAMING_INTERVAL = float(os.environ.get("BOT_STREAMING_INTERVAL", "1.0"))
+STREAMING_MIN_CHARS = int(os.environ.get("BOT_STREAMING_MIN_CHARS", "200"))
+
 
 # Callback hanlder used for the bot service to inform the client of the thought process before the final response
-class BotServiceCallbackHandler(BaseCallbackHandler):
+class BotServiceCallbackHandler(AsyncCallbackHandler):
     """Callback handler to use in Bot Builder Application"""
     
     def __init__(self, turn_context: TurnContext) -> None:
@@ -48,26 +53,103 @@ class BotServiceCallbackHandler(BaseCallbackHandler):
         await self.tc.send_activity(f"\u2611{action.log} ...")
         await self.tc.send_activity(Activity(type=ActivityTypes.typing))
 
+
+
+# Delivers a streamed answer to the channel without sending one activity per token
+class StreamingReply:
+    """Coalesces streamed tokens and pushes them to the channel.
+    "update" mode sends the first window as a message and then edits it in place, "chunked" mode sends each window
+    as a follow-up message cut at a line break, "off" sends the whole answer at the end."""
+
+    def __init__(self, turn_context: TurnContext, mode: str = "chunked", interval: float = STREAMING_INTERVAL, min_chars: int = STREAMING_MIN_CHARS) -> None:
+        self.tc = turn_context
+        self.mode = mode
+        self.interval = interval
+        self.min_chars = min_chars
+        self.text = ""
+        self._sent = 0  # Number of characters of self.text already delivered
+        self._activity_id = None
+        self._last_flush = time.monotonic()
+
+    @staticmethod
+    def mode_for_channel(channel_id: str) -> str:
+        if STREAMING_MODE != "auto":
+            return STREAMING_MODE
+        return "update" if channel_id in STREAMING_UPDATE_CHANNELS else "chunked"
+
+    async def add(self, token: str) -> None:
+        self.text += token
+        if self.mode == "off":
+            return
+        pending = len(self.text) - self._sent
+        if pending >= self.min_chars or (pending and time.monotonic() - self._last_flush >= self.interval):
+            await self._flush(final=False)
+
+    async def finish(self) -> str:
+        """Delivers whatever is left and returns the full answer"""
+        await self._flush(final=True)
+        return self.text
+
+    async def _flush(self, final: bool) -> None:
+        with span("bot_send", mode=self.mode):
+            if self.mode == "update":
+                await self._flush_update(final)
+            else:
+                await self._flush_chunk(final)
+        self._last_flush = time.monotonic()
+
+    async def _flush_update(self, final: bool) -> None:
+        if len(self.text) == self._sent:
+            return
+        try:
+            if self._activity_id is None:
+                response = await self.tc.send_activity(self.text)
+                self._activity_id = response.id if response else None
+                if self._activity_id is None:
+                    # Without an activity id there is nothing to edit, keep going with follow-up messages
+                    self.mode = "chunked"
+            else:
+                activity = MessageFactory.text(self.text)
+                activity.id = self._activity_id
+                await self.tc.update_activity(activity)
+            self._sent = len(self.text)
+        except Exception as e:
+            logging.warning(f"Updating the activity failed, falling back to chunked messages: {e}")
+            self.mode = "chunked"
+            await self._flush_chunk(final)
+
+    async def _flush_chunk(self, final: bool) -> None:
+        pending = self.text[self._sent:]
+        if not final:
+            # Cut at a paragraph or line break so markdown is not split in the middle of a block
+            cut = pending.rfind("\n\n")
+            if cut < 0:
+                cut = pending.rfind("\n")
+            if cut < 0 and len(pending) >= 4 * self.min_chars:
+                cut = pending.rfind(" ")
+            if cut <= 0:
+                return
+            pending = pending[:cut + 1]
+        if pending.strip():
+            await self.tc.send_activity(pending)
+        self._sent += len(pending)
+
             
 # Bot Class
 class MyBot(ActivityHandler):
     
     def __init__(self):
         self.model_name = os.environ.get("AZURE_OPENAI_MODEL_NAME") 
+        # One history store per process, prepared at startup in app.py
+        self.history_store = CosmosDBHistoryStore.from_env()
+        # Answers to repeated questions, None when no embedding deployment is configured
+        self.answer_cache = SemanticAnswerCache.from_env(indexes=[os.environ['AZURE_SEARCH_INDEX']])
+        # The chain is built once per process (see CHAIN_REGISTRY.warm() in app.py) and reused by every turn
+        CHAIN_REGISTRY.register(DOCSEARCH_CHAIN, lambda: build_docsearch_chain(self.get_session_history, model_name=self.model_name, answer_cache=self.answer_cache))
         
-    def get_session_history(self, session_id: str, user_id: str) -> CosmosDBChatMessageHistory:
-        cosmos = CosmosDBChatMessageHistory(
-            cosmos_endpoint=os.environ['AZURE_COSMOSDB_ENDPOINT'],
-            cosmos_database=os.environ['AZURE_COSMOS_DATABASE_NAME'],
-            cosmos_container=os.environ['AZURE_COSMOSDB_CONTAINER_NAME'],
-            connection_string=os.environ['AZURE_COMOSDB_CONNECTION_STRING'],
-            session_id=session_id,
-            user_id=user_id
-            )
-
-        # prepare the cosmosdb instance
-        cosmos.prepare_cosmos()
-        return cosmos
+    def get_session_history(self, session_id: str, user_id: str) -> CachedChatMessageHistory:
+        # No I/O here, the history is loaded from the cache or Cosmos and written back in the background
+        return self.history_store.get_session_history(session_id, user_id)
     
     # Function to show welcome message to new users
     async def on_members_added_activity(self, members_added: ChannelAccount, turn_context: TurnContext):
@@ -97,63 +179,25 @@ class MyBot(ActivityHandler):
         input_text_metadata["locale"] = turn_context.activity.locale if turn_context.activity.locale else "Not Available"
 
         # Setting the query to send to OpenAI
-        input_text = turn_context.activity.text + "\n\n metadata:\n" + str(input_text_metadata)    
+        input_text = turn_context.activity.text + METADATA_SEPARATOR + str(input_text_metadata)    
             
-        # Set Callback Handler
+        # Set Callback Handler, only the per-turn config changes between turns
         cb_handler = BotServiceCallbackHandler(turn_context)
-        cb_manager = CallbackManager(handlers=[cb_handler])
+        brain_agent_executor = CHAIN_REGISTRY.get(DOCSEARCH_CHAIN)
 
-        # DocSearch tool
-        indexes = [os.environ['AZURE_SEARCH_INDEX']]
+        with span("turn", channel=turn_context.activity.channel_id):
+            with span("bot_send", mode="typing"):
+                await turn_context.send_activity(Activity(type=ActivityTypes.typing))
+            config={"configurable": {"session_id": session_id, "user_id": user_id}, "callbacks": [cb_handler]}
 
-        # Set LLM 
-        llm = AzureChatOpenAI(deployment_name=self.model_name, temperature=0, 
-                              max_tokens=1500, callback_manager=cb_manager, streaming=True)
-        
-        retriever = CustomAzureSearchRetriever(indexes=indexes, topK=20, reranker_threshold=1, sas_token=os.environ['BLOB_SAS_TOKEN'])
-
-        chain = (
-            {
-                "context": itemgetter("question") | retriever, 
-                "question": itemgetter("question"),
-                "history": itemgetter("history")
-            }
-            | DOCSEARCH_PROMPT
-            | llm
-        )
-
-        brain_agent_executor = RunnableWithMessageHistory(
-            chain,
-            self.get_session_history,
-            input_messages_key="question",
-            history_messages_key="history",
-            history_factory_config=[
-                ConfigurableFieldSpec(
-                    id="user_id",
-                    annotation=str,
-                    name="User ID",
-                    description="Unique identifier for the user.",
-                    default="",
-                    is_shared=True,
-                ),
-                ConfigurableFieldSpec(
-                    id="session_id",
-                    annotation=str,
-                    name="Session ID",
-                    description="Unique identifier for the conversation.",
-                    default="",
-                    is_shared=True,
-                ),
-            ],
-        ) | StrOutputParser()
-
-        await turn_context.send_activity(Activity(type=ActivityTypes.typing))
-        config={"configurable": {"session_id": session_id, "user_id": user_id}}
-        answer = brain_agent_executor.invoke({"question": input_text}, config=config)
-        await turn_context.send_activity(answer)
+            # Stream the answer to the channel as it is generated
+            reply = StreamingReply(turn_context, mode=StreamingReply.mode_for_channel(turn_context.activity.channel_id))
+            async for chunk in brain_agent_executor.astream({"question": input_text}, config=config):
+                await reply.add(chunk)
+            answer = await reply.finish()
 
         answer_ended = time.time()
-        logging.warning(f"Took: {answer_ended - answer_started}s to answer")
+        logging.warning(f"Took: {answer_ended - answer_started}s to answer ({len(answer)} characters)")
         logging.warning("---------------------------------------------- TURN ENDS ----------------------------------------------")
 
 
@@ -0,0 +1,150 @@
+import os
+import time
+import asyncio
+
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict
+
+from .tracing import METRICS
+
+
+ADMISSION_WAIT = METRICS.histogram("admission_wait_seconds", "Time a turn waited in the admission queue")
+ADMISSION_REJECTED = METRICS.counter("admission_rejected_total", "Turns shed by the admission control")
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str):
+        super().__init__(f"Turn not admitted: {reason}")
+        self.reason = reason
+
+
+class _Waiter:
+    __slots__ = ("future", "user_id", "conversation_id")
+
+    def __init__(self, future: asyncio.Future, user_id: str, conversation_id: str):
+        self.future = future
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+
+
+class AdmissionController:
+    """Bounds the number of turns running at once in the worker.
+
+    A turn runs when the global, per-user and per-conversation limits allow it, otherwise it waits in a FIFO
+    queue for at most max_wait seconds. A turn blocked by its own user or conversation does not hold back
+    the ones queued behind it. When the queue is full or the wait is too long the turn is rejected.
+    A limit of 0 means no limit. Meant to be used from the event loop of the web worker only."""
+
+    def __init__(self, max_concurrent: int = 16, max_per_user: int = 2, max_per_conversation: int = 1,
+                 max_queue: int = 64, max_wait: float = 30):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_per_conversation = max_per_conversation
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.running = 0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {"queue_full": 0, "timeout": 0}
+        self._per_user: Dict[str, int] = {}
+        self._per_conversation: Dict[str, int] = {}
+        self._queue: Deque[_Waiter] = deque()
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        return cls(
+            max_concurrent=int(os.environ.get("ADMISSION_MAX_CONCURRENT", "16")),
+            max_per_user=int(os.environ.get("ADMISSION_MAX_PER_USER", "2")),
+            max_per_conversation=int(os.environ.get("ADMISSION_MAX_PER_CONVERSATION", "1")),
+            max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", "64")),
+            max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", "30")),
+        )
+
+    def _can_run(self, user_id: str, conversation_id: str) -> bool:
+        return ((not self.max_concurrent or self.running < self.max_concurrent)
+                and (not self.max_per_user or self._per_user.get(user_id, 0) < self.max_per_user)
+                and (not self.max_per_conversation or self._per_conversation.get(conversation_id, 0) < self.max_per_conversation))
+
+    def _take(self, user_id: str, conversation_id: str) -> None:
+        self.running += 1
+        self.admitted += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self._per_conversation[conversation_id] = self._per_conversation.get(conversation_id, 0) + 1
+
+    def _release(self, user_id: str, conversation_id: str) -> None:
+        self.running -= 1
+        for counts, key in ((self._per_user, user_id), (self._per_conversation, conversation_id)):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        # Hand the free slots to the oldest waiters that are allowed to run
+        for waiter in list(self._queue):
+            if self.max_concurrent and self.running >= self.max_concurrent:
+                break
+            if waiter.future.done():
+                self._queue.remove(waiter)
+            elif self._can_run(waiter.user_id, waiter.conversation_id):
+                self._queue.remove(waiter)
+                self._take(waiter.user_id, waiter.conversation_id)
+                waiter.future.set_result(None)
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        ADMISSION_REJECTED.inc(reason=reason)
+        return AdmissionRejected(reason)
+
+    async def acquire(self, user_id: str, conversation_id: str) -> None:
+        if not self._queue and self._can_run(user_id, conversation_id):
+            self._take(user_id, conversation_id)
+            ADMISSION_WAIT.observe(0.0)
+            return
+        if self.max_queue and len(self._queue) >= self.max_queue:
+            raise self._reject("queue_full")
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), user_id, conversation_id)
+        self._queue.append(waiter)
+        self._dispatch()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.max_wait or None)
+        except asyncio.TimeoutError:
+            if waiter in self._queue:
+                self._queue.remove(waiter)
+            if not waiter.future.done():
+                waiter.future.cancel()
+                raise self._reject("timeout")
+        except asyncio.CancelledError:
+            if waiter in self._queue:
+                self._queue.remove(waiter)
+            if waiter.future.done() and not waiter.future.cancelled():
+                # The slot was granted while the request was going away
+                self._release(user_id, conversation_id)
+            else:
+                waiter.future.cancel()
+            raise
+        finally:
+            ADMISSION_WAIT.observe(time.monotonic() - started)
+
+    def release(self, user_id: str, conversation_id: str) -> None:
+        self._release(user_id, conversation_id)
+
+    @asynccontextmanager
+    async def admit(self, user_id: str, conversation_id: str) -> AsyncIterator[None]:
+        """Waits for a slot and holds it for the duration of the block, raises AdmissionRejected when shedding"""
+        await self.acquire(user_id, conversation_id)
+        try:
+            yield
+        finally:
+            self.release(user_id, conversation_id)
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": len(self._queue),
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected.get("queue_full", 0),
+            "rejected_timeout": self.rejected.get("timeout", 0),
+        }
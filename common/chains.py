@@ -0,0 +1,183 @@
+import os
+import logging
+import threading
+
+from operator import itemgetter
+from typing import Callable, Dict, List, Optional
+
+from langchain_openai import AzureChatOpenAI
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import ConfigurableFieldSpec, Runnable, RunnableLambda, RunnablePassthrough
+from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.output_parsers import StrOutputParser
+
+from .utils import CustomAzureSearchRetriever, pack_documents
+from .prompts import DOCSEARCH_PROMPT, DOCSEARCH_PROMPT_TEXT
+from .semantic_cache import SemanticAnswerCache
+from .tracing import LLMTimingCallbackHandler, span
+from .ratelimit import get_rate_limited_http_clients
+from .tokenizer import get_tokenizer
+
+
+# Name under which the DOCSEARCH RAG chain is registered
+DOCSEARCH_CHAIN = "docsearch"
+
+# Config fields passed to the get_session_history factory on every turn
+HISTORY_FACTORY_CONFIG = [
+    ConfigurableFieldSpec(
+        id="user_id",
+        annotation=str,
+        name="User ID",
+        description="Unique identifier for the user.",
+        default="",
+        is_shared=True,
+    ),
+    ConfigurableFieldSpec(
+        id="session_id",
+        annotation=str,
+        name="Session ID",
+        description="Unique identifier for the conversation.",
+        default="",
+        is_shared=True,
+    ),
+]
+
+
+def render_context_document(doc: Document) -> str:
+    # DOCSEARCH_PROMPT renders {context} as str() of the list of documents: their repr, metadata (source URL
+    # with the SAS token, score...) included, separated by ", "
+    return repr(doc) + ", "
+
+
+class ContextPacker:
+    """Fits the retrieved documents in a prompt token budget, next to the history and the question.
+
+    The budget covers the whole DOCSEARCH prompt except the answer, the documents are counted as the prompt
+    renders them (see render_context_document). They come from the retriever in score order, so the best
+    ones are kept and the tail is truncated or dropped.
+    At least min_context_tokens are left for the context however long the history is.
+    Tokens are counted with the encoding of model (the chat deployment by default)."""
+
+    def __init__(self, max_prompt_tokens: int = 12000, min_context_tokens: int = 2000, model: Optional[str] = None):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.min_context_tokens = min_context_tokens
+        self.tokenizer = get_tokenizer(model)
+        self.prompt_tokens = self.tokenizer.count(DOCSEARCH_PROMPT_TEXT)
+
+    @classmethod
+    def from_env(cls, model: Optional[str] = None) -> "ContextPacker":
+        return cls(
+            max_prompt_tokens=int(os.environ.get("DOCSEARCH_PROMPT_TOKEN_BUDGET", "12000")),
+            min_context_tokens=int(os.environ.get("DOCSEARCH_MIN_CONTEXT_TOKENS", "2000")),
+            model=model,
+        )
+
+    def context_budget(self, question: str, history: List[BaseMessage]) -> int:
+        # The history messages are counted again on every turn of the conversation, their counts are memoized
+        texts = [question] + [message.content for message in history if isinstance(message.content, str)]
+        used = self.prompt_tokens + sum(self.tokenizer.count_batch(texts))
+        return max(self.min_context_tokens, self.max_prompt_tokens - used)
+
+    def __call__(self, input: dict) -> List[Document]:
+        docs = input["context"]
+        with span("prompt_build"):
+            budget = self.context_budget(input["question"], input.get("history") or [])
+            packed, kept, dropped = pack_documents(docs, budget, encoding_name=self.tokenizer.name,
+                                                   render=render_context_document)
+        if dropped:
+            logging.warning(f"Context packing: kept {len(packed)}/{len(docs)} chunks, {kept} tokens, "
+                            f"saved {dropped} tokens (budget {budget})")
+        return packed
+
+
+def build_docsearch_chain(get_session_history: Callable,
+                          model_name: Optional[str] = None,
+                          indexes: Optional[List[str]] = None,
+                          topK: int = 20,
+                          reranker_threshold: int = 1,
+                          sas_token: Optional[str] = None,
+                          answer_cache: Optional[SemanticAnswerCache] = None,
+                          context_packer: Optional[ContextPacker] = None) -> Runnable:
+    """Builds the DOCSEARCH RAG chain with chat history.
+    Nothing turn specific is bound here: session_id, user_id and callbacks are passed in the config of each call.
+    With an answer_cache, the first question of a conversation can be answered from the cache (skipping the search
+    and the LLM), the answer is still added to the history.
+    The retrieved documents are fitted in the prompt token budget of context_packer (ContextPacker.from_env() by default)."""
+
+    # The HTTP clients go through the process TPM/RPM limiter shared with the agents
+    http_client, http_async_client = get_rate_limited_http_clients()
+    llm = AzureChatOpenAI(deployment_name=model_name or os.environ.get("AZURE_OPENAI_MODEL_NAME"),
+                          temperature=0, max_tokens=1500, streaming=True,
+                          callbacks=[LLMTimingCallbackHandler()],
+                          http_client=http_client, http_async_client=http_async_client)
+
+    retriever = CustomAzureSearchRetriever(
+        indexes=indexes or [os.environ['AZURE_SEARCH_INDEX']],
+        topK=topK,
+        reranker_threshold=reranker_threshold,
+        sas_token=sas_token if sas_token is not None else os.environ['BLOB_SAS_TOKEN']
+    )
+
+    chain = (
+        {
+            "context": itemgetter("question") | retriever,
+            "question": itemgetter("question"),
+            "history": itemgetter("history")
+        }
+        | RunnablePassthrough.assign(context=RunnableLambda(context_packer or ContextPacker.from_env(model_name), name="pack_context"))
+        | DOCSEARCH_PROMPT
+        | llm
+    )
+
+    if answer_cache is not None:
+        chain = answer_cache.wrap(chain)
+
+    return RunnableWithMessageHistory(
+        chain,
+        get_session_history,
+        input_messages_key="question",
+        history_messages_key="history",
+        history_factory_config=HISTORY_FACTORY_CONFIG,
+    ) | StrOutputParser()
+
+
+class ChainRegistry:
+    """Process-wide registry of warm runnables.
+    Chains are built once (at startup with warm() or lazily on first use) and shared by every turn,
+    so the LLM and retriever clients, and their HTTP connections, are reused."""
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Runnable]] = {}
+        self._chains: Dict[str, Runnable] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, factory: Callable[[], Runnable], replace: bool = False) -> None:
+        with self._lock:
+            if name in self._factories and not replace:
+                return
+            self._factories[name] = factory
+            self._chains.pop(name, None)
+
+    def get(self, name: str) -> Runnable:
+        chain = self._chains.get(name)
+        if chain is None:
+            with self._lock:
+                chain = self._chains.get(name)
+                if chain is None:
+                    if name not in self._factories:
+                        raise KeyError(f"No chain registered under '{name}'")
+                    chain = self._factories[name]()
+                    self._chains[name] = chain
+        return chain
+
+    def warm(self) -> None:
+        """Builds every registered chain that is not built yet."""
+        for name in list(self._factories):
+            self.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._factories
+
+
+CHAIN_REGISTRY = ChainRegistry()
@@ -0,0 +1,108 @@
+import os
+import json
+import zlib
+import pickle
+import struct
+
+from typing import Any, Optional
+
+from langgraph.serde.jsonplus import JsonPlusSerializer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Header of a serialized checkpoint: magic, format version, codec, compression, then from version 2 the
+# uncompressed size of the payload
+MAGIC = b"NVCK"
+FORMAT_VERSION = 2
+_HEADER_V1 = struct.Struct("!4sBBB")
+_HEADER = struct.Struct("!4sBBBI")
+
+CODEC_JSONPLUS = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+_COMPRESSIONS = {"none": COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "zstd": COMPRESSION_ZSTD}
+
+
+class CompactJsonPlusSerializer(JsonPlusSerializer):
+    """langgraph's type preserving JSON (messages, datetimes, sets... come back as they were), without whitespace"""
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, default=self._default, ensure_ascii=False, separators=(",", ":")).encode("utf-8", "ignore")
+
+
+class CheckpointSerializer:
+    """Serializer of the checkpoints stored by SQLAlchemyCheckpointSaver.
+
+    A blob is an 11 bytes header (magic, format version, codec, compression, uncompressed size) followed by the
+    encoded checkpoint (version 1 blobs, without the size, are still read).
+    Checkpoints are encoded as JSON (no Python class layout in the rows) and compressed with zstd when the
+    zstandard package is installed, zlib otherwise, if they are larger than min_compress_bytes.
+    Blobs without the header are rows written with pickle before, they are still read when allow_pickle is set
+    (see SQLAlchemyCheckpointSaver.migrate_checkpoints to rewrite them)."""
+
+    def __init__(self, compression: Optional[str] = None, level: int = 3, min_compress_bytes: int = 256,
+                 allow_pickle: bool = True):
+        if compression is None:
+            compression = "zstd" if zstandard is not None else "zlib"
+        if compression not in _COMPRESSIONS:
+            raise ValueError(f"Unknown checkpoint compression {compression!r}, expected one of {list(_COMPRESSIONS)}")
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("zstd compression of the checkpoints needs the zstandard package")
+        self.compression = _COMPRESSIONS[compression]
+        self.level = level
+        self.min_compress_bytes = min_compress_bytes
+        self.allow_pickle = allow_pickle
+        self.codec = CompactJsonPlusSerializer()
+
+    @classmethod
+    def from_env(cls) -> "CheckpointSerializer":
+        return cls(
+            compression=os.environ.get("CHECKPOINT_COMPRESSION") or None,
+            level=int(os.environ.get("CHECKPOINT_COMPRESSION_LEVEL", "3")),
+            min_compress_bytes=int(os.environ.get("CHECKPOINT_COMPRESSION_MIN_BYTES", "256")),
+        )
+
+    @staticmethod
+    def is_current(data: bytes) -> bool:
+        return data[:len(MAGIC)] == MAGIC
+
+    @staticmethod
+    def raw_size(data: bytes) -> int:
+        """Uncompressed size of the encoded checkpoint, len(data) when the blob does not record it"""
+        if CheckpointSerializer.is_current(data) and len(data) >= _HEADER.size and data[len(MAGIC)] >= 2:
+            return _HEADER.unpack_from(data)[4]
+        return len(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        payload = self.codec.dumps(obj)
+        raw_size = len(payload)
+        compression = self.compression if len(payload) >= self.min_compress_bytes else COMPRESSION_NONE
+        if compression == COMPRESSION_ZSTD:
+            payload = zstandard.ZstdCompressor(level=self.level).compress(payload)
+        elif compression == COMPRESSION_ZLIB:
+            payload = zlib.compress(payload, self.level)
+        return _HEADER.pack(MAGIC, FORMAT_VERSION, CODEC_JSONPLUS, compression, raw_size) + payload
+
+    def loads(self, data: bytes) -> Any:
+        data = bytes(data)
+        if not self.is_current(data):
+            if not self.allow_pickle:
+                raise ValueError("Checkpoint written with pickle, run migrate_checkpoints or set allow_pickle")
+            return pickle.loads(data)
+        _, version, codec, compression = _HEADER_V1.unpack_from(data)
+        if version > FORMAT_VERSION or codec != CODEC_JSONPLUS:
+            raise ValueError(f"Unsupported checkpoint format version {version} codec {codec}")
+        payload = memoryview(data)[(_HEADER_V1 if version == 1 else _HEADER).size:]
+        if compression == COMPRESSION_ZSTD:
+            if zstandard is None:
+                raise ImportError("Checkpoint compressed with zstd, the zstandard package is needed to read it")
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        elif compression == COMPRESSION_ZLIB:
+            payload = zlib.decompress(payload)
+        return self.codec.loads(bytes(payload))
@@ -0,0 +1,245 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from azure.cosmos import CosmosClient, ContainerProxy, PartitionKey
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, messages_from_dict, messages_to_dict
+
+from .cache import LRUCache
+from .tracing import span
+
+
+class CosmosDBHistoryStore:
+    """Process-wide chat history store backed by Azure CosmosDB.
+
+    - one Cosmos client per process, the database/container is prepared once with prepare()
+    - recently active conversations are kept in an LRU cache, so a turn does not re-read its whole history
+    - new messages are written back by a background thread (write-behind), flush() / close() drain the queue
+
+    The documents keep the layout of langchain's CosmosDBChatMessageHistory (id=session_id, partition key /user_id).
+    The cache is per process: with several workers serving the same conversation, keep cache_ttl short."""
+
+    def __init__(self, connection_string: str, database: str, container: str, ttl: Optional[int] = None,
+                 cache_size: int = 1000, cache_ttl: Optional[float] = 300, retry_delay: float = 1.0):
+        self.connection_string = connection_string
+        self.database = database
+        self.container = container
+        self.ttl = ttl
+        self.retry_delay = retry_delay
+        self._client: Optional[CosmosClient] = None
+        self._container: Optional[ContainerProxy] = None
+        self._prepare_lock = threading.Lock()
+        self._async_clients: Dict[asyncio.AbstractEventLoop, AsyncCosmosClient] = {}
+        self._cache = LRUCache(max_size=cache_size, ttl=cache_ttl)
+
+        # Write-behind state: latest document of every conversation waiting to be written
+        self._pending: Dict[Tuple[str, str], dict] = {}
+        self._inflight = 0
+        self._closing = False
+        self._writer: Optional[threading.Thread] = None
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_env(cls) -> "CosmosDBHistoryStore":
+        return cls(
+            connection_string=os.environ['AZURE_COMOSDB_CONNECTION_STRING'],
+            database=os.environ['AZURE_COSMOS_DATABASE_NAME'],
+            container=os.environ['AZURE_COSMOSDB_CONTAINER_NAME'],
+            cache_size=int(os.environ.get("HISTORY_CACHE_SIZE", "1000")),
+            cache_ttl=float(os.environ.get("HISTORY_CACHE_TTL", "300")),
+        )
+
+    def prepare(self) -> None:
+        """Opens the client and creates the database and container if needed. Call it once at startup."""
+        with self._prepare_lock:
+            if self._container is None:
+                self._client = CosmosClient.from_connection_string(self.connection_string)
+                database = self._client.create_database_if_not_exists(self.database)
+                self._container = database.create_container_if_not_exists(
+                    self.container,
+                    partition_key=PartitionKey("/user_id"),
+                    default_ttl=self.ttl,
+                )
+
+    def get_session_history(self, session_id: str, user_id: str) -> "CachedChatMessageHistory":
+        # No I/O here, so it is safe to use as the get_session_history factory inside the event loop
+        return CachedChatMessageHistory(self, session_id=session_id, user_id=user_id)
+
+    def _async_container(self):
+        # The async client is bound to the event loop it was created in
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = AsyncCosmosClient.from_connection_string(self.connection_string)
+            self._async_clients[loop] = client
+        return client.get_database_client(self.database).get_container_client(self.container)
+
+    def _cached(self, key: Tuple[str, str]) -> Optional[List[BaseMessage]]:
+        messages = self._cache.get(key)
+        if messages is None:
+            with self._cond:
+                document = self._pending.get(key)
+            if document is not None:
+                # Evicted from the cache but not written yet
+                messages = messages_from_dict(document["messages"])
+                self._cache.set(key, messages)
+        return messages
+
+    def load(self, session_id: str, user_id: str) -> List[BaseMessage]:
+        key = (user_id, session_id)
+        messages = self._cached(key)
+        if messages is None:
+            self.prepare()
+            with span("history_load"):
+                try:
+                    item = self._container.read_item(item=session_id, partition_key=user_id)
+                    messages = messages_from_dict(item.get("messages", []))
+                except CosmosResourceNotFoundError:
+                    messages = []
+            self._cache.set(key, messages)
+        return list(messages)
+
+    async def aload(self, session_id: str, user_id: str) -> List[BaseMessage]:
+        key = (user_id, session_id)
+        messages = self._cached(key)
+        if messages is None:
+            with span("history_load"):
+                try:
+                    item = await self._async_container().read_item(item=session_id, partition_key=user_id)
+                    messages = messages_from_dict(item.get("messages", []))
+                except CosmosResourceNotFoundError:
+                    messages = []
+            self._cache.set(key, messages)
+        return list(messages)
+
+    def append(self, session_id: str, user_id: str, history: List[BaseMessage], new_messages: Sequence[BaseMessage]) -> None:
+        """Adds messages to a conversation and queues the write, no I/O on the caller's side"""
+        key = (user_id, session_id)
+        messages = history + list(new_messages)
+        self._cache.set(key, messages)
+        document = {"id": session_id, "user_id": user_id, "messages": messages_to_dict(messages)}
+        with self._cond:
+            self._pending[key] = document
+            self._ensure_writer()
+            self._cond.notify_all()
+
+    def clear(self, session_id: str, user_id: str) -> None:
+        key = (user_id, session_id)
+        with self._cond:
+            self._pending.pop(key, None)
+        self._cache.set(key, [])
+        self.prepare()
+        try:
+            self._container.delete_item(item=session_id, partition_key=user_id)
+        except CosmosResourceNotFoundError:
+            pass
+
+    def _ensure_writer(self) -> None:
+        if self._writer is None or not self._writer.is_alive():
+            self._closing = False
+            self._writer = threading.Thread(target=self._write_behind, name="history-writer", daemon=True)
+            self._writer.start()
+
+    def _write_behind(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, {}
+                self._inflight = len(batch)
+                closing = self._closing
+
+            failed = False
+            for key, document in batch.items():
+                try:
+                    self.prepare()
+                    with span("history_save"):
+                        self._container.upsert_item(body=document)
+                except Exception as e:
+                    failed = True
+                    if closing:
+                        logging.error(f"Chat history of session {key[1]} could not be written on shutdown: {e}")
+                        continue
+                    logging.warning(f"Writing chat history of session {key[1]} failed, retrying: {e}")
+                    with self._cond:
+                        # Retry unless a newer version of the conversation is already queued
+                        self._pending.setdefault(key, document)
+
+            with self._cond:
+                self._inflight = 0
+                self._cond.notify_all()
+            if failed and not closing:
+                time.sleep(self.retry_delay)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until every queued write has landed. Returns False on timeout."""
+        with self._cond:
+            if self._pending:
+                self._ensure_writer()
+                self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._pending and not self._inflight, timeout=timeout)
+
+    def close(self, timeout: Optional[float] = 30) -> None:
+        """Flushes the queued writes and stops the writer thread"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            writer = self._writer
+        if writer is not None:
+            writer.join(timeout)
+
+    async def aclose(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+    def stats(self) -> dict:
+        stats = self._cache.stats()
+        stats["pending_writes"] = len(self._pending)
+        return stats
+
+
+class CachedChatMessageHistory(BaseChatMessageHistory):
+    """Chat history of one conversation served by a CosmosDBHistoryStore (sync and async)"""
+
+    def __init__(self, store: CosmosDBHistoryStore, session_id: str, user_id: str):
+        self.store = store
+        self.session_id = session_id
+        self.user_id = user_id
+        self._messages: Optional[List[BaseMessage]] = None
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        if self._messages is None:
+            self._messages = self.store.load(self.session_id, self.user_id)
+        return self._messages
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        if self._messages is None:
+            self._messages = await self.store.aload(self.session_id, self.user_id)
+        return list(self._messages)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.store.append(self.session_id, self.user_id, self.messages, messages)
+        self._messages = self._messages + list(messages)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        history = await self.aget_messages()
+        self.store.append(self.session_id, self.user_id, history, messages)
+        self._messages = history + list(messages)
+
+    def clear(self) -> None:
+        self.store.clear(self.session_id, self.user_id)
+        self._messages = []
+
+    async def aclear(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.clear)
@@ -0,0 +1,459 @@
+import os
+import json
+import time
+import base64
+import random
+import hashlib
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional
+
+import openai
+import requests
+
+from azure.cosmos import CosmosClient, ContainerProxy, PartitionKey
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from langchain_core.embeddings import Embeddings
+from langchain_openai import AzureOpenAIEmbeddings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from .utils import iter_pdf_pages, get_requests_session, _pdf_name, _search_headers_and_params
+from .tokenizer import get_tokenizer
+
+
+# Characters per chunk and overlap between the chunks of a page
+CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", "5000"))
+CHUNK_OVERLAP = int(os.environ.get("INGEST_CHUNK_OVERLAP", "100"))
+# Chunks per embedding request and embedding / upload requests running at once
+EMBED_BATCH_SIZE = int(os.environ.get("INGEST_EMBED_BATCH_SIZE", "64"))
+EMBED_CONCURRENCY = int(os.environ.get("INGEST_EMBED_CONCURRENCY", "4"))
+UPLOAD_CONCURRENCY = int(os.environ.get("INGEST_UPLOAD_CONCURRENCY", "4"))
+INGEST_MAX_RETRIES = int(os.environ.get("INGEST_MAX_RETRIES", "8"))
+# An upload request carries up to 16 MB of documents and vectors, far more than a search request
+UPLOAD_TIMEOUT = float(os.environ.get("INGEST_UPLOAD_TIMEOUT", "300"))
+# Azure AI Search accepts at most 1000 documents and 16 MB per indexing request
+MAX_UPLOAD_DOCUMENTS = 1000
+MAX_UPLOAD_BYTES = 15 * 1024 * 1024
+
+
+def document_name(file) -> str:
+    return os.path.splitext(os.path.basename(_pdf_name(file)))[0]
+
+
+def chunk_title(name: str, page_num: int, chunk_num: int) -> str:
+    """Title of a chunk in the index, page_num is 1-based (see extract_file_info)"""
+    return f"{name}.pdf_page_{page_num}_chunk_{chunk_num}"
+
+
+def extract_page_number(title: str) -> int:
+    return int(title.rsplit("_page_", 1)[1].split("_chunk_", 1)[0])
+
+
+def extract_chunk_number(title: str) -> int:
+    return int(title.rsplit("_chunk_", 1)[1])
+
+
+def chunk_key(title: str) -> str:
+    # Index keys only allow letters, digits, '_', '-' and '='
+    return base64.urlsafe_b64encode(title.encode("utf-8")).decode("utf-8")
+
+
+def iter_pdf_chunks(file, name: Optional[str] = None, location: str = "", chunk_size: int = CHUNK_SIZE,
+                    chunk_overlap: int = CHUNK_OVERLAP, **parse_kwargs) -> Iterator[dict]:
+    """Yields the index documents of a PDF (without their vector) page by page, as the pages are extracted"""
+    name = name or document_name(file)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    for page_num, offset, page_text in iter_pdf_pages(file, **parse_kwargs):
+        for chunk_num, chunk in enumerate(splitter.split_text(page_text)):
+            title = chunk_title(name, page_num + 1, chunk_num)
+            yield {"id": chunk_key(title), "title": title, "name": name, "location": location, "chunk": chunk}
+
+
+def upload_documents(index: str, documents: List[dict], action: str = "mergeOrUpload") -> List[dict]:
+    """Sends one batch of documents to the index, returns the per document results"""
+    headers, params = _search_headers_and_params()
+    payload = {"value": [{"@search.action": action, **document} for document in documents]}
+    resp = get_requests_session().post(os.environ['AZURE_SEARCH_ENDPOINT'] + "/indexes/" + index + "/docs/index",
+                                       data=json.dumps(payload), headers=headers, params=params, timeout=UPLOAD_TIMEOUT)
+    resp.raise_for_status()
+    return resp.json()["value"]
+
+
+def get_embeddings() -> Embeddings:
+    # The pipeline retries throttled batches itself, with the backoff the service asks for
+    return AzureOpenAIEmbeddings(azure_deployment=os.environ["AZURE_OPENAI_EMBEDDING_MODEL_NAME"],
+                                 chunk_size=EMBED_BATCH_SIZE, max_retries=0)
+
+
+class Throttled(Exception):
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__("Throttled by the service")
+        self.retry_after = retry_after
+
+
+def _retry_after(headers) -> Optional[float]:
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def with_retry(function: Callable, *args, retries: int = INGEST_MAX_RETRIES, base_delay: float = 1.0):
+    """Calls function(*args), retrying with exponential backoff (or the service's retry-after) when throttled,
+    and when the request timed out or the connection failed"""
+    for attempt in range(retries + 1):
+        try:
+            return function(*args)
+        except (Throttled, openai.RateLimitError, openai.APIConnectionError, requests.HTTPError,
+                requests.ConnectionError, requests.Timeout) as e:
+            if isinstance(e, Throttled):
+                retry_after = e.retry_after
+            elif isinstance(e, openai.RateLimitError):
+                retry_after = _retry_after(e.response.headers)
+            elif isinstance(e, requests.HTTPError):
+                if e.response is None or e.response.status_code not in (429, 503):
+                    raise
+                retry_after = _retry_after(e.response.headers)
+            else:
+                retry_after = None
+            if attempt == retries:
+                raise
+            time.sleep(min(60.0, retry_after or base_delay * 2 ** attempt * random.uniform(0.5, 1.5)))
+
+
+class IndexingPipeline:
+    """Embeds and uploads index documents in the background.
+
+    Documents are embedded by batches of embed_batch_size with embed_concurrency requests at once, then uploaded
+    in requests as large as Azure AI Search accepts with upload_concurrency requests at once. Throttled requests
+    (and the documents the index answers 429/503 for) are retried. add() blocks when enough batches are in
+    flight, so memory stays bounded. flush() waits until everything added so far is in the index, discard() drops
+    what is not sent yet (e.g. the rest of a file that failed) so it does not fail the next flush."""
+
+    def __init__(self, index: str, embeddings: Optional[Embeddings] = None, embed_batch_size: int = EMBED_BATCH_SIZE,
+                 embed_concurrency: int = EMBED_CONCURRENCY, upload_concurrency: int = UPLOAD_CONCURRENCY,
+                 verbose: bool = False):
+        self.index = index
+        self.embeddings = embeddings or get_embeddings()
+        self.tokenizer = get_tokenizer(os.environ.get("AZURE_OPENAI_EMBEDDING_MODEL_NAME"))
+        self.embed_batch_size = embed_batch_size
+        self.verbose = verbose
+        self._embed_executor = ThreadPoolExecutor(embed_concurrency, thread_name_prefix="embed")
+        self._upload_executor = ThreadPoolExecutor(upload_concurrency, thread_name_prefix="upload")
+        self._embed_slots = threading.BoundedSemaphore(embed_concurrency * 2)
+        self._upload_slots = threading.BoundedSemaphore(upload_concurrency * 2)
+        self._lock = threading.Lock()
+        self._to_embed: List[dict] = []
+        self._to_upload: List[dict] = []
+        self._to_upload_bytes = 0
+        self._embedding: List[Future] = []
+        self._uploading: List[Future] = []
+        self.chunks = 0
+        self.tokens = 0
+        self.deleted = 0
+        self._flushed = (0, 0)
+        self._started = time.monotonic()
+
+    def add(self, document: dict) -> None:
+        self._to_embed.append(document)
+        if len(self._to_embed) >= self.embed_batch_size:
+            self._submit_embedding()
+
+    def delete(self, keys: List[str]) -> None:
+        for start in range(0, len(keys), MAX_UPLOAD_DOCUMENTS):
+            batch = [{"id": key} for key in keys[start:start + MAX_UPLOAD_DOCUMENTS]]
+            self._submit_upload(batch, action="delete")
+
+    def _submit_embedding(self) -> None:
+        batch, self._to_embed = self._to_embed, []
+        self._embed_slots.acquire()
+        future = self._embed_executor.submit(self._embed, batch)
+        future.add_done_callback(lambda _: self._embed_slots.release())
+        with self._lock:
+            self._embedding.append(future)
+
+    def _embed(self, batch: List[dict]) -> None:
+        texts = [document["chunk"] for document in batch]
+        vectors = with_retry(self.embeddings.embed_documents, texts)
+        tokens = sum(map(len, self.tokenizer.encode_batch(texts)))
+        for document, vector in zip(batch, vectors):
+            document["chunkVector"] = vector
+        ready = []
+        with self._lock:
+            self.tokens += tokens
+            for document in batch:
+                size = len(json.dumps(document))
+                if self._to_upload and (len(self._to_upload) >= MAX_UPLOAD_DOCUMENTS
+                                        or self._to_upload_bytes + size > MAX_UPLOAD_BYTES):
+                    ready.append(self._to_upload)
+                    self._to_upload, self._to_upload_bytes = [], 0
+                self._to_upload.append(document)
+                self._to_upload_bytes += size
+        for documents in ready:
+            self._submit_upload(documents)
+
+    def _submit_upload(self, documents: List[dict], action: str = "mergeOrUpload") -> None:
+        self._upload_slots.acquire()
+        future = self._upload_executor.submit(self._upload, documents, action)
+        future.add_done_callback(lambda _: self._upload_slots.release())
+        with self._lock:
+            self._uploading.append(future)
+
+    def _upload(self, documents: List[dict], action: str) -> None:
+        pending = documents
+
+        def send():
+            nonlocal pending
+            results = upload_documents(self.index, pending, action=action)
+            failed = {result["key"] for result in results if not result["status"]}
+            throttled = {result["key"] for result in results if not result["status"] and result.get("statusCode") in (429, 503)}
+            if failed - throttled:
+                errors = [result.get("errorMessage") for result in results if result["key"] in failed - throttled]
+                raise RuntimeError(f"{len(failed - throttled)} documents were rejected by the index: {errors[:3]}")
+            if throttled:
+                pending = [document for document in pending if document["id"] in throttled]
+                raise Throttled()
+
+        with_retry(send)
+        with self._lock:
+            if action == "delete":
+                self.deleted += len(documents)
+            else:
+                self.chunks += len(documents)
+
+
+    def flush(self) -> dict:
+        """Waits until every document added so far is embedded and uploaded, raises the first error.
+        Returns the chunks uploaded and deleted by the index since the previous flush (or discard)"""
+        if self._to_embed:
+            self._submit_embedding()
+        with self._lock:
+            embedding, self._embedding = self._embedding, []
+        wait(embedding)
+        with self._lock:
+            documents, self._to_upload, self._to_upload_bytes = self._to_upload, [], 0
+        if documents:
+            self._submit_upload(documents)
+        with self._lock:
+            uploading, self._uploading = self._uploading, []
+        wait(uploading)
+        for future in embedding + uploading:
+            if future.exception() is not None:
+                raise future.exception()
+        return self._since_flush()
+
+    def discard(self) -> None:
+        """Drops the documents not sent yet and waits for the requests in flight, ignoring their errors"""
+        self._to_embed = []
+        with self._lock:
+            embedding, self._embedding = self._embedding, []
+        wait(embedding)
+        with self._lock:
+            self._to_upload, self._to_upload_bytes = [], 0
+            uploading, self._uploading = self._uploading, []
+        wait(uploading)
+        self._since_flush()
+
+    def _since_flush(self) -> dict:
+        with self._lock:
+            chunks, deleted = self._flushed
+            self._flushed = (self.chunks, self.deleted)
+        return {"chunks": self.chunks - chunks, "deleted": self.deleted - deleted}
+
+    def shutdown(self) -> None:
+        self._embed_executor.shutdown()
+        self._upload_executor.shutdown()
+
+    def close(self) -> dict:
+        """Flushes and stops the workers, returns the throughput of the run"""
+        try:
+            self.flush()
+        finally:
+            self.shutdown()
+        return self.stats()
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self._started
+        stats = {
+            "chunks": self.chunks,
+            "tokens": self.tokens,
+            "deleted": self.deleted,
+            "seconds": round(elapsed, 2),
+            "chunks_per_s": round(self.chunks / elapsed, 1) if elapsed else 0.0,
+            "tokens_per_s": round(self.tokens / elapsed, 1) if elapsed else 0.0,
+        }
+        if self.verbose:
+            print(f"Indexed {stats['chunks']} chunks ({stats['tokens']} tokens) in {stats['seconds']}s: "
+                  f"{stats['chunks_per_s']} chunks/s, {stats['tokens_per_s']} tokens/s")
+        return stats
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+# Hex characters kept of a chunk's hash in the document log, enough to tell a changed chunk
+CHUNK_DIGEST_CHARS = 16
+
+
+def chunk_digests(entry: dict) -> Dict[int, List[str]]:
+    """Digests of the chunks indexed from a document, by page and chunk number, from its document-log entry.
+    Entries written before the digests were kept per page (a hash by chunk title) are read too."""
+    if "chunk_digests" in entry:
+        return {int(page): digests for page, digests in entry["chunk_digests"].items()}
+    pages: Dict[int, Dict[int, str]] = {}
+    for title, digest in entry.get("chunk_hashes", {}).items():
+        pages.setdefault(extract_page_number(title), {})[extract_chunk_number(title)] = digest[:CHUNK_DIGEST_CHARS]
+    return {page: [chunks.get(i, "") for i in range(max(chunks) + 1)] for page, chunks in pages.items()}
+
+
+def file_hash(file) -> str:
+    """Hash of the bytes of a file (path or file object), read by blocks"""
+    digest = hashlib.sha256()
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    else:
+        file.seek(0)
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+        file.seek(0)
+    return digest.hexdigest()
+
+
+class DocumentLog:
+    """The document-log container (see pages/01_Documents.py), one entry per document.
+    Besides the status shown on the Documents page, an entry keeps the hash of the file and a short digest of
+    every chunk indexed from it (a list per page, see chunk_digests), so a re-upload only re-embeds the chunks
+    that changed."""
+
+    def __init__(self, container: ContainerProxy):
+        self.container = container
+
+    @classmethod
+    def from_env(cls) -> "DocumentLog":
+        client = CosmosClient.from_connection_string(os.environ['AZURE_COMOSDB_CONNECTION_STRING'])
+        database = client.create_database_if_not_exists(id=os.environ['AZURE_COSMOS_DATABASE_NAME'])
+        container = database.create_container_if_not_exists(id=os.environ.get("DOCUMENT_LOG_CONTAINER_NAME", "document-log"),
+                                                            partition_key=PartitionKey("/id"))
+        return cls(container)
+
+    @staticmethod
+    def document_id(name: str) -> str:
+        return chunk_key(name)
+
+    def get(self, document_id: str) -> Optional[dict]:
+        try:
+            return self.container.read_item(item=document_id, partition_key=document_id)
+        except CosmosResourceNotFoundError:
+            return None
+
+    def save(self, entry: dict) -> None:
+        entry["updated_at"] = datetime.now(timezone.utc).isoformat()
+        self.container.upsert_item(body=entry)
+
+
+def index_pdf(file, index: str, location: str = "", embeddings: Optional[Embeddings] = None,
+              pipeline: Optional[IndexingPipeline] = None, document_log: Optional[DocumentLog] = None,
+              force: bool = False, **kwargs) -> dict:
+    """Extracts, chunks, embeds and uploads a PDF as a stream through an IndexingPipeline (a new one unless given),
+    so only the batches in flight are in memory.
+
+    With a document_log the indexing is incremental: an unchanged file is skipped without being parsed,
+    otherwise only the chunks whose hash changed are embedded and uploaded and the chunks of removed pages
+    are deleted from the index. force=True re-indexes everything.
+    Returns counts of the chunks indexed, unchanged and deleted (as acknowledged by the index).
+    A shared pipeline must not have work pending from another file, see index_pdf_files."""
+    name = kwargs.pop("name", None) or document_name(file)
+    report = {"document": name, "indexed": 0, "unchanged": 0, "deleted": 0, "skipped": False}
+
+    entry = None
+    previous: Dict[int, List[str]] = {}
+    if document_log is not None:
+        document_id = DocumentLog.document_id(name)
+        file_digest = file_hash(file)
+        entry = document_log.get(document_id) or {"id": document_id, "document_name": name, "document_url": location,
+                                                   "pages": 0, "status": "", "error": ""}
+        if not force and entry.get("status") == "indexed" and entry.get("content_hash") == file_digest \
+                and entry.get("document_url") == location:
+            report["skipped"] = True
+            report["unchanged"] = sum(map(len, chunk_digests(entry).values()))
+            return report
+        previous = {} if force else chunk_digests(entry)
+        entry.update({"document_url": location, "status": "processing", "error": ""})
+        document_log.save(entry)
+
+    own_pipeline = pipeline is None
+    if own_pipeline:
+        pipeline = IndexingPipeline(index, embeddings=embeddings)
+    digests: Dict[int, List[str]] = {}
+    pages = 0
+    try:
+        for document in iter_pdf_chunks(file, name=name, location=location, **kwargs):
+            digest = content_hash(location + "\n" + document["chunk"])[:CHUNK_DIGEST_CHARS]
+            page_num = extract_page_number(document["title"])
+            page_digests = digests.setdefault(page_num, [])
+            page_digests.append(digest)
+            pages = max(pages, page_num)
+            if previous.get(page_num, [])[len(page_digests) - 1:len(page_digests)] == [digest]:
+                report["unchanged"] += 1
+                continue
+            pipeline.add(document)
+
+        removed = [chunk_title(name, page_num, chunk_num) for page_num, page_digests in previous.items()
+                   for chunk_num in range(len(digests.get(page_num, [])), len(page_digests))]
+        pipeline.delete([chunk_key(title) for title in removed])
+        # The log is only updated once the chunks are in the index
+        flushed = pipeline.flush()
+        report.update({"indexed": flushed["chunks"], "deleted": flushed["deleted"]})
+        if own_pipeline:
+            report.update(pipeline.stats())
+    except Exception as e:
+        # The rest of this file must not be uploaded with (or fail) the next file of a shared pipeline
+        pipeline.discard()
+        if entry is not None:
+            # The previous hashes are kept, so the next run redoes whatever did not land
+            entry.update({"status": "failed", "error": str(e)})
+            document_log.save(entry)
+        raise
+    finally:
+        if own_pipeline:
+            pipeline.shutdown()
+
+    if entry is not None:
+        entry.update({"status": "indexed", "error": "", "pages": pages, "content_hash": file_digest,
+                      "chunk_digests": {str(page_num): page_digests for page_num, page_digests in digests.items()}})
+        entry.pop("chunk_hashes", None)
+        document_log.save(entry)
+    return report
+
+
+def index_pdf_files(files, index: str, locations: Optional[List[str]] = None, document_log: Optional[DocumentLog] = None,
+                    pipeline: Optional[IndexingPipeline] = None, verbose: bool = False, **kwargs) -> List[dict]:
+    """Indexes a corpus one file after another through one pipeline, so the embedding and upload batches span
+    files. A file that fails is reported and does not stop the others. With verbose the throughput of the run
+    (chunks/s, tokens/s) is printed at the end, it is also available from pipeline.stats() when one is given."""
+    own_pipeline = pipeline is None
+    if own_pipeline:
+        pipeline = IndexingPipeline(index, embeddings=kwargs.pop("embeddings", None), verbose=verbose)
+    reports = []
+    for i, file in enumerate(files):
+        location = locations[i] if locations else ""
+        try:
+            report = index_pdf(file, index, location=location, pipeline=pipeline, document_log=document_log, **kwargs)
+        except Exception as e:
+            report = {"document": document_name(file), "error": str(e)}
+        if verbose:
+            print(report)
+        reports.append(report)
+    if own_pipeline:
+        pipeline.close()
+    return reports
+
@@ -6,6 +6,10 @@ Hello and welcome! \U0001F44B
 
 My name is Noventiq Bot. How can I help you today?
 """
+
+BUSY_MESSAGE = """
+I am answering a lot of questions right now. Please send your message again in a moment.
+"""
 ###########################################################
 
 CUSTOM_CHATBOT_PREFIX = """
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import asyncio
+import threading
+
+from typing import Optional, Tuple
+
+import httpx
+from langchain_openai import AzureChatOpenAI
+
+from .tracing import METRICS
+from .tokenizer import count_tokens
+
+
+RATE_LIMIT_WAIT = METRICS.histogram("openai_rate_limit_wait_seconds", "Time an Azure OpenAI request waited for the rate limiter")
+RATE_LIMITED = METRICS.counter("openai_throttled_total", "Azure OpenAI requests answered with 429")
+
+
+class TokenBucket:
+    """Token bucket refilled at `per_minute` per minute, holding at most `burst_seconds` worth of it.
+    take() reserves the amount right away and returns how long the caller has to wait for it, so callers
+    are served in order and never wait longer than needed."""
+
+    def __init__(self, per_minute: float, burst_seconds: float = 10):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, amount: float, now: float) -> float:
+        self._refill(now)
+        self.level -= amount
+        return -self.level / self.rate if self.level < 0 else 0.0
+
+    def cap(self, remaining: float, now: float) -> None:
+        """Lowers the level to what the service says is left, e.g. when other workers share the deployment"""
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+
+class OpenAIRateLimiter:
+    """Process-wide tokens-per-minute and requests-per-minute limiter for one Azure OpenAI deployment.
+    A limit of 0 disables the corresponding bucket."""
+
+    def __init__(self, tokens_per_minute: float = 0, requests_per_minute: float = 0, burst_seconds: float = 10):
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.requests = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "OpenAIRateLimiter":
+        return cls(
+            tokens_per_minute=float(os.environ.get("AZURE_OPENAI_TPM", "0")),
+            requests_per_minute=float(os.environ.get("AZURE_OPENAI_RPM", "0")),
+            burst_seconds=float(os.environ.get("AZURE_OPENAI_RATE_BURST_SECONDS", "10")),
+        )
+
+    def reserve(self, tokens: int) -> float:
+        """Reserves capacity for a request, returns the number of seconds to wait before sending it"""
+        now = time.monotonic()
+        with self._lock:
+            wait = max(0.0, self._blocked_until - now)
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.take(tokens, now))
+            if self.requests is not None:
+                wait = max(wait, self.requests.take(1, now))
+        RATE_LIMIT_WAIT.observe(wait)
+        return wait
+
+    def acquire(self, tokens: int) -> None:
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int) -> None:
+        wait = self.reserve(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, status_code: int, headers: httpx.Headers) -> None:
+        now = time.monotonic()
+        with self._lock:
+            remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+            if remaining_tokens is not None and self.tokens is not None:
+                self.tokens.cap(float(remaining_tokens), now)
+            remaining_requests = headers.get("x-ratelimit-remaining-requests")
+            if remaining_requests is not None and self.requests is not None:
+                self.requests.cap(float(remaining_requests), now)
+            if status_code == 429:
+                RATE_LIMITED.inc()
+                if headers.get("retry-after-ms"):
+                    retry_after = float(headers["retry-after-ms"]) / 1000
+                else:
+                    retry_after = float(headers.get("retry-after") or 1)
+                # Hold every caller until the service accepts requests again, the client retry then goes through
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            for bucket in (self.tokens, self.requests):
+                if bucket is not None:
+                    bucket._refill(now)
+            return {
+                "tokens_available": self.tokens.level if self.tokens is not None else -1,
+                "requests_available": self.requests.level if self.requests is not None else -1,
+                "blocked_seconds": max(0.0, self._blocked_until - now),
+            }
+
+
+def estimate_request_tokens(content: bytes) -> int:
+    """Tokens a chat completion request counts against the TPM quota: the prompt plus max_tokens"""
+    try:
+        body = json.loads(content)
+    except ValueError:
+        return 1
+    if not isinstance(body, dict):
+        return 1
+    prompt = json.dumps(body.get("messages", []), ensure_ascii=False)
+    if body.get("tools") or body.get("functions"):
+        prompt += json.dumps(body.get("tools") or body.get("functions"), ensure_ascii=False)
+    try:
+        prompt_tokens = count_tokens(prompt, body.get("model"))
+    except Exception:
+        prompt_tokens = len(prompt) // 4
+    return prompt_tokens + int(body.get("max_tokens") or 0)
+
+
+class RateLimitedTransport(httpx.HTTPTransport):
+    def __init__(self, limiter: OpenAIRateLimiter, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.limiter.acquire(estimate_request_tokens(request.read()))
+        response = super().handle_request(request)
+        self.limiter.update_from_headers(response.status_code, response.headers)
+        return response
+
+
+class AsyncRateLimitedTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, limiter: OpenAIRateLimiter, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self.limiter.aacquire(estimate_request_tokens(await request.aread()))
+        response = await super().handle_async_request(request)
+        self.limiter.update_from_headers(response.status_code, response.headers)
+        return response
+
+
+_limiter: Optional[OpenAIRateLimiter] = None
+_http_clients: Optional[Tuple[httpx.Client, httpx.AsyncClient]] = None
+_clients_lock = threading.Lock()
+
+
+def get_rate_limiter() -> OpenAIRateLimiter:
+    global _limiter
+    with _clients_lock:
+        if _limiter is None:
+            _limiter = OpenAIRateLimiter.from_env()
+            METRICS.add_collector("openai_rate_limiter", _limiter.stats)
+        return _limiter
+
+
+def get_rate_limited_http_clients() -> Tuple[httpx.Client, httpx.AsyncClient]:
+    """HTTP clients for the openai SDK, shared by every LLM of the process so they share one quota"""
+    global _http_clients
+    limiter = get_rate_limiter()
+    with _clients_lock:
+        if _http_clients is None:
+            timeout = httpx.Timeout(600, connect=10)
+            _http_clients = (
+                httpx.Client(transport=RateLimitedTransport(limiter), timeout=timeout),
+                httpx.AsyncClient(transport=AsyncRateLimitedTransport(limiter), timeout=timeout),
+            )
+        return _http_clients
+
+
+def rate_limited(llm: AzureChatOpenAI) -> AzureChatOpenAI:
+    """Returns the model with its requests going through the process rate limiter (the same model if they already do)"""
+    http_client, http_async_client = get_rate_limited_http_clients()
+    if llm.http_client is http_client:
+        return llm
+    values = {name: getattr(llm, name) for name in llm.__fields__ if name not in ("client", "async_client")}
+    values.update(http_client=http_client, http_async_client=http_async_client)
+    return type(llm)(**values)
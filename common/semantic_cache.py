@@ -0,0 +1,294 @@
+import os
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from langchain_openai import AzureOpenAIEmbeddings
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import patch_config
+
+from .utils import get_index_stats, aget_index_stats, invalidate_search_cache, normalize_question
+
+
+class _Entry:
+    __slots__ = ("vector", "answer", "expires_at")
+
+    def __init__(self, vector: np.ndarray, answer: str, expires_at: float):
+        self.vector = vector
+        self.answer = answer
+        self.expires_at = expires_at
+
+
+class SemanticAnswerCache:
+    """Answer cache keyed on the embedding of the normalized question.
+
+    A question hits when its cosine similarity with a cached question is at least `threshold`.
+    Entries expire after `ttl` seconds and the least recently used ones are dropped past `max_size`.
+    Questions shorter than `min_words` are never cached, follow-ups like "tell me more" depend on the conversation.
+    When `indexes` are given, their stats are checked every `index_check_interval` seconds and the cache is
+    cleared when they change, i.e. when the index was re-ingested."""
+
+    def __init__(self, embeddings: Embeddings, threshold: float = 0.95, ttl: float = 86400, max_size: int = 1000,
+                 min_words: int = 3, indexes: Optional[List[str]] = None, index_check_interval: float = 60,
+                 report_every: int = 100):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.min_words = min_words
+        self.indexes = indexes or []
+        self.index_check_interval = index_check_interval
+        self.report_every = report_every
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._matrix: Optional[np.ndarray] = None  # Stacked vectors of _entries, rebuilt after a change
+        self._keys: List[str] = []
+        self._lock = threading.Lock()
+        self._index_fingerprint = None
+        self._next_index_check = 0.0
+
+    @classmethod
+    def from_env(cls, indexes: Optional[List[str]] = None) -> Optional["SemanticAnswerCache"]:
+        """Builds the cache from the environment, returns None when no embedding deployment is configured"""
+        deployment = os.environ.get("AZURE_OPENAI_EMBEDDING_MODEL_NAME")
+        if not deployment or os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() != "true":
+            return None
+        return cls(
+            embeddings=AzureOpenAIEmbeddings(azure_deployment=deployment),
+            threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95")),
+            ttl=float(os.environ.get("ANSWER_CACHE_TTL", "86400")),
+            max_size=int(os.environ.get("ANSWER_CACHE_SIZE", "1000")),
+            indexes=indexes,
+        )
+
+    def wrap(self, runnable: Runnable) -> "SemanticCacheRunnable":
+        """Puts the cache in front of a runnable that takes {"question": ...} and returns an AI message"""
+        return SemanticCacheRunnable(cache=self, runnable=runnable)
+
+    # Lookup and update, the key is the normalized question and its normalized embedding
+    def _cacheable(self, key: str) -> bool:
+        return len(key.split()) >= self.min_words
+
+    def _match(self, key: str, vector: Optional[np.ndarray], count: bool = True) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and vector is not None and self._entries:
+                if self._matrix is None:
+                    self._keys = list(self._entries)
+                    self._matrix = np.stack([self._entries[k].vector for k in self._keys])
+                scores = self._matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    key = self._keys[best]
+                    entry = self._entries[key]
+            if entry is not None and entry.expires_at <= now:
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            elif count:
+                self.misses += 1
+            if entry is not None or count:
+                self._report()
+        return entry.answer if entry is not None else None
+
+    def _store(self, key: str, vector: np.ndarray, answer: str) -> None:
+        with self._lock:
+            self._entries[key] = _Entry(vector, answer, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def _remove(self, key: str) -> None:
+        self._entries.pop(key, None)
+        self._matrix = None
+
+    @staticmethod
+    def _normalize_vector(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, question: str) -> Tuple[Optional[str], str, Optional[np.ndarray]]:
+        """Returns (answer or None, key, vector). Pass key and vector back to update() on a miss."""
+        key = normalize_question(question)
+        if not self._cacheable(key):
+            return None, key, None
+        self._check_indexes()
+        # Exact match first, it needs no embedding call
+        answer = self._match(key, None, count=False)
+        if answer is not None:
+            return answer, key, None
+        try:
+            vector = self._normalize_vector(self.embeddings.embed_query(key))
+        except Exception as e:
+            # A failed embedding is a miss without a vector, so the answer is not stored either
+            logging.warning(f"Answer cache: could not embed the question, treated as a miss: {e}")
+            return self._match(key, None), key, None
+        return self._match(key, vector), key, vector
+
+    async def alookup(self, question: str) -> Tuple[Optional[str], str, Optional[np.ndarray]]:
+        key = normalize_question(question)
+        if not self._cacheable(key):
+            return None, key, None
+        await self._acheck_indexes()
+        answer = self._match(key, None, count=False)
+        if answer is not None:
+            return answer, key, None
+        try:
+            vector = self._normalize_vector(await self.embeddings.aembed_query(key))
+        except Exception as e:
+            logging.warning(f"Answer cache: could not embed the question, treated as a miss: {e}")
+            return self._match(key, None), key, None
+        return self._match(key, vector), key, vector
+
+    def update(self, key: str, vector: Optional[np.ndarray], answer: str) -> None:
+        # No vector when the question was not cacheable, was an exact hit or could not be embedded
+        if vector is not None and answer:
+            self._store(key, vector, answer)
+
+    def invalidate(self) -> None:
+        """Drops every cached answer, e.g. after the index was re-ingested"""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self.invalidations += 1
+
+    # Invalidation on re-ingestion, detected from the index stats
+    def _index_check_due(self) -> bool:
+        if not self.indexes or time.monotonic() < self._next_index_check:
+            return False
+        self._next_index_check = time.monotonic() + self.index_check_interval
+        return True
+
+    def _on_index_stats(self, fingerprint: tuple) -> None:
+        if self._index_fingerprint is not None and fingerprint != self._index_fingerprint:
+            logging.warning(f"Search indexes {self.indexes} changed, clearing the answer and search caches")
+            self.invalidate()
+            for index in self.indexes:
+                invalidate_search_cache(index)
+        self._index_fingerprint = fingerprint
+
+    def _check_indexes(self) -> None:
+        if not self._index_check_due():
+            return
+        try:
+            stats = [get_index_stats(index) for index in self.indexes]
+        except Exception as e:
+            logging.warning(f"Could not read the search index stats: {e}")
+            return
+        self._on_index_stats(tuple((s.get("documentCount"), s.get("storageSize")) for s in stats))
+
+    async def _acheck_indexes(self) -> None:
+        if not self._index_check_due():
+            return
+        try:
+            stats = [await aget_index_stats(index) for index in self.indexes]
+        except Exception as e:
+            logging.warning(f"Could not read the search index stats: {e}")
+            return
+        self._on_index_stats(tuple((s.get("documentCount"), s.get("storageSize")) for s in stats))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+    def _report(self) -> None:
+        lookups = self.hits + self.misses
+        if self.report_every and lookups % self.report_every == 0:
+            logging.warning(f"Answer cache: {self.stats()}")
+
+
+class SemanticCacheRunnable(Runnable[Dict[str, Any], BaseMessage]):
+    """Runnable returning the cached answer on a hit and running (then caching) the wrapped runnable on a miss.
+    Only the first question of a conversation goes through the cache: with a history the answer depends on the
+    conversation, not only on the question the key is built from."""
+
+    def __init__(self, cache: SemanticAnswerCache, runnable: Runnable, question_key: str = "question",
+                 history_key: str = "history"):
+        self.cache = cache
+        self.runnable = runnable
+        self.question_key = question_key
+        self.history_key = history_key
+
+    def _lookup(self, input: Dict[str, Any]) -> Tuple[Optional[str], str, Optional[np.ndarray]]:
+        if input.get(self.history_key):
+            return None, "", None
+        return self.cache.lookup(input[self.question_key])
+
+    async def _alookup(self, input: Dict[str, Any]) -> Tuple[Optional[str], str, Optional[np.ndarray]]:
+        if input.get(self.history_key):
+            return None, "", None
+        return await self.cache.alookup(input[self.question_key])
+
+    def _invoke(self, input: Dict[str, Any], run_manager, config: RunnableConfig) -> BaseMessage:
+        answer, key, vector = self._lookup(input)
+        if answer is not None:
+            return AIMessage(content=answer)
+        output = self.runnable.invoke(input, patch_config(config, callbacks=run_manager.get_child()))
+        self.cache.update(key, vector, output.content)
+        return output
+
+    async def _ainvoke(self, input: Dict[str, Any], run_manager, config: RunnableConfig) -> BaseMessage:
+        answer, key, vector = await self._alookup(input)
+        if answer is not None:
+            return AIMessage(content=answer)
+        output = await self.runnable.ainvoke(input, patch_config(config, callbacks=run_manager.get_child()))
+        self.cache.update(key, vector, output.content)
+        return output
+
+    def _transform(self, input_iter: Iterator[Dict[str, Any]], run_manager, config: RunnableConfig) -> Iterator[BaseMessage]:
+        input = next(input_iter)
+        answer, key, vector = self._lookup(input)
+        if answer is not None:
+            yield AIMessageChunk(content=answer)
+            return
+        content = ""
+        for chunk in self.runnable.stream(input, patch_config(config, callbacks=run_manager.get_child())):
+            content += chunk.content
+            yield chunk
+        self.cache.update(key, vector, content)
+
+    async def _atransform(self, input_iter: AsyncIterator[Dict[str, Any]], run_manager, config: RunnableConfig) -> AsyncIterator[BaseMessage]:
+        input = await input_iter.__anext__()
+        answer, key, vector = await self._alookup(input)
+        if answer is not None:
+            yield AIMessageChunk(content=answer)
+            return
+        content = ""
+        async for chunk in self.runnable.astream(input, patch_config(config, callbacks=run_manager.get_child())):
+            content += chunk.content
+            yield chunk
+        self.cache.update(key, vector, content)
+
+    def invoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> BaseMessage:
+        return self._call_with_config(self._invoke, input, config, **kwargs)
+
+    async def ainvoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> BaseMessage:
+        return await self._acall_with_config(self._ainvoke, input, config, **kwargs)
+
+    def stream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[BaseMessage]:
+        yield from self._transform_stream_with_config(iter([input]), self._transform, config, **kwargs)
+
+    async def astream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[BaseMessage]:
+        async def input_aiter():
+            yield input
+        async for chunk in self._atransform_stream_with_config(input_aiter(), self._atransform, config, **kwargs):
+            yield chunk
@@ -1,27 +1,47 @@
 from langchain.pydantic_v1 import BaseModel, Field
-from sqlalchemy import create_engine, Column, Integer, String, LargeBinary, Table, MetaData, PrimaryKeyConstraint, select
+from sqlalchemy import create_engine, Column, Integer, String, LargeBinary, Table, MetaData, PrimaryKeyConstraint, select, func
 from sqlalchemy.orm import sessionmaker, Session, scoped_session
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.engine import URL
-from sqlalchemy import Engine
-from typing import Iterator, Optional, Any
+from sqlalchemy import Connection, Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from typing import AsyncIterator, Iterator, List, Optional, Any, Tuple, Union
 from types import TracebackType
-import pickle
+from datetime import datetime, timedelta, timezone
+import os
+import copy
+import time
+import asyncio
+import logging
+import threading
+import queue
+from concurrent.futures import Future
 from contextlib import AbstractContextManager, contextmanager
 from langchain_core.runnables import RunnableConfig
 from typing_extensions import Self
 
 from langgraph.checkpoint.base import (
-    BaseCheckpointSaver,
     Checkpoint,
-    CheckpointAt,
     CheckpointTuple,
-    Serializable,
+    SerializerProtocol,
 )
 
+from .cache import SizedLRUCache
+from .checkpoint_serde import CheckpointSerializer
+from .tracing import METRICS
+
 
 metadata = MetaData()
 
+# Async drivers of the sync ones, for db_config['async_drivername'] / CHECKPOINT_DB_ASYNC_DRIVERNAME
+ASYNC_DRIVERS = {
+    "mssql+pyodbc": "mssql+aioodbc",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "mysql+pymysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+}
+
 # Adjusting the column type from String (which defaults to VARCHAR(max)) to a specific length
 checkpoints_table = Table(
     'checkpoints', metadata,
@@ -32,27 +52,345 @@ checkpoints_table = Table(
     PrimaryKeyConstraint('thread_id', 'thread_ts')
 )
 
+# Checkpoints read per query by list/alist
+LIST_PAGE_SIZE = int(os.environ.get("CHECKPOINT_LIST_PAGE_SIZE", "20"))
+
+WRITE_BATCH_ROWS = METRICS.histogram("checkpoint_write_batch_rows", "Checkpoints written per group commit",
+                                     buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+COMPACTION_ROWS = METRICS.counter("checkpoint_compaction_rows_total", "Checkpoint rows deleted by the retention policy")
+COMPACTION_BYTES = METRICS.counter("checkpoint_compaction_bytes_total", "Checkpoint bytes deleted by the retention policy")
+
+
+class RetentionPolicy:
+    """What the compaction of the checkpoints table keeps: the keep_last newest checkpoints of each thread,
+    and only the threads with a checkpoint in the last max_idle_days. 0 disables either rule.
+    Rows are deleted batch_size at a time, each batch in its own short transaction."""
+
+    def __init__(self, keep_last: int = 20, max_idle_days: float = 30, batch_size: int = 500, interval: float = 3600):
+        self.keep_last = keep_last
+        self.max_idle_days = max_idle_days
+        self.batch_size = batch_size
+        self.interval = interval
+
+    @classmethod
+    def from_env(cls) -> "RetentionPolicy":
+        return cls(
+            keep_last=int(os.environ.get("CHECKPOINT_KEEP_LAST", "20")),
+            max_idle_days=float(os.environ.get("CHECKPOINT_MAX_IDLE_DAYS", "30")),
+            batch_size=int(os.environ.get("CHECKPOINT_COMPACTION_BATCH_SIZE", "500")),
+            interval=float(os.environ.get("CHECKPOINT_COMPACTION_INTERVAL", "3600")),
+        )
+
+
+class _CachedCheckpoint:
+    __slots__ = ("thread_ts", "parent_ts", "checkpoint", "cached_at")
+
+    def __init__(self, thread_ts: str, parent_ts: Optional[str], checkpoint: Checkpoint):
+        self.thread_ts = thread_ts
+        self.parent_ts = parent_ts
+        self.checkpoint = checkpoint
+        self.cached_at = time.monotonic()
+
+
+class LatestCheckpointCache:
+    """Latest checkpoint of each thread, as written by put or read by get_tuple in this process.
+
+    An entry cached less than max_staleness seconds ago is used as is. An older one is used only after checking
+    that its thread_ts is still the latest of the thread in the table, a primary key lookup that reads and
+    decodes no checkpoint, so the checkpoints written by other workers are seen. The default max_staleness of 0
+    always checks. max_bytes bounds the uncompressed serialized size of the cached checkpoints (their JSON),
+    the deserialized objects take a few times more memory.
+    Cached checkpoints are returned as is, callers must not modify them (langgraph copies them)."""
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, max_staleness: float = 0.0):
+        self.max_staleness = max_staleness
+        self.validated = 0
+        self.stale = 0
+        self._entries = SizedLRUCache(max_bytes)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional["LatestCheckpointCache"]:
+        max_bytes = int(os.environ.get("CHECKPOINT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+        if not max_bytes:
+            return None
+        return cls(max_bytes=max_bytes, max_staleness=float(os.environ.get("CHECKPOINT_CACHE_MAX_STALENESS", "0")))
+
+    def get(self, thread_id: str) -> Optional[_CachedCheckpoint]:
+        return self._entries.get(thread_id)
+
+    def is_fresh(self, entry: _CachedCheckpoint) -> bool:
+        return time.monotonic() - entry.cached_at < self.max_staleness
+
+    def store(self, thread_id: str, thread_ts: str, parent_ts: Optional[str], checkpoint: Checkpoint, size: int) -> None:
+        with self._lock:
+            current = self._entries.peek(thread_id)
+            # A slower writer or reader must not replace a newer checkpoint
+            if current is None or current.thread_ts <= thread_ts:
+                self._entries.set(thread_id, _CachedCheckpoint(thread_ts, parent_ts, checkpoint), size)
+
+    def discard(self, thread_id: str) -> None:
+        self._entries.pop(thread_id)
+
+    def stats(self) -> dict:
+        return {**self._entries.stats(), "validated": self.validated, "stale": self.stale}
+
+
+class CheckpointBatchWriter:
+    """Group commit of checkpoint inserts.
+
+    Rows submitted by concurrent callers are collected for at most max_delay seconds after the first one,
+    or until max_rows are waiting, then written with one multi-row insert in one transaction by a writer thread.
+    The future of each row is resolved when its transaction is committed (or fails), so a caller waiting for it
+    has the same guarantee as with its own commit. If a batch fails, its rows are written one by one so that only
+    the faulty ones (e.g. a duplicate thread_ts) fail."""
+
+    def __init__(self, engine: Engine, max_rows: int = 100, max_delay: float = 0.005):
+        self.engine = engine
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.batches = 0
+        self.rows = 0
+        self._queue: "queue.Queue[Optional[Tuple[dict, Future]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, engine: Engine) -> Optional["CheckpointBatchWriter"]:
+        if os.environ.get("CHECKPOINT_GROUP_COMMIT", "false").lower() != "true":
+            return None
+        return cls(
+            engine,
+            max_rows=int(os.environ.get("CHECKPOINT_GROUP_COMMIT_MAX_ROWS", "100")),
+            max_delay=float(os.environ.get("CHECKPOINT_GROUP_COMMIT_MAX_DELAY_MS", "5")) / 1000,
+        )
+
+    def submit(self, row: dict) -> Future:
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+                self._thread.start()
+            self._queue.put((row, future))
+        return future
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_rows:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            # Rows whose caller went away (cancelled aput) are not written, the others can no longer be cancelled
+            batch = [(row, future) for row, future in batch if future.set_running_or_notify_cancel()]
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception as e:
+                # Nothing may stop the writer thread, the callers would wait forever
+                logging.exception("Checkpoint batch writer failed")
+                for _, future in batch:
+                    self._resolve(future, error=e)
+            if stop:
+                return
+
+    @staticmethod
+    def _resolve(future: Future, error: Optional[BaseException] = None) -> None:
+        if not future.done():
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def _write(self, batch: List[Tuple[dict, Future]]) -> None:
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(checkpoints_table.insert(), [row for row, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                self._resolve(batch[0][1], error=e)
+                return
+            for item in batch:
+                self._write([item])
+            return
+        self.batches += 1
+        self.rows += len(batch)
+        WRITE_BATCH_ROWS.observe(len(batch))
+        for _, future in batch:
+            self._resolve(future)
+
+    def close(self) -> None:
+        """Writes what is waiting and stops the writer thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "rows": self.rows, "rows_per_batch": self.rows / self.batches if self.batches else 0.0}
+
+
+class LazyCheckpointItem(dict):
+    """Item of SQLAlchemyCheckpointSaver.list: "configurable" and "additional_info" are plain values,
+    "checkpoint" is only deserialized the first time it is read. Anything that goes through all the entries
+    (iteration, keys/items/values, dict(item), json.dumps, copies, comparison) reads it first, so the item
+    behaves like the plain dict it replaces."""
+
+    def __init__(self, blob: bytes, serde: SerializerProtocol, **fields):
+        super().__init__(**fields)
+        self._blob = blob
+        self._serde = serde
+
+    def _load(self) -> None:
+        if self._blob is not None:
+            dict.__setitem__(self, "checkpoint", self._serde.loads(self._blob))
+            self._blob = None
+
+    def __missing__(self, key):
+        if key != "checkpoint" or self._blob is None:
+            raise KeyError(key)
+        self._load()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key) -> bool:
+        return (key == "checkpoint" and self._blob is not None) or super().__contains__(key)
+
+    def __len__(self) -> int:
+        return super().__len__() + (self._blob is not None)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __setitem__(self, key, value) -> None:
+        if key == "checkpoint":
+            self._blob = None
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key) -> None:
+        self._load()
+        super().__delitem__(key)
+
+    def pop(self, key, *default):
+        self._load()
+        return super().pop(key, *default)
+
+    def popitem(self):
+        self._load()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self._load()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs) -> None:
+        self._load()
+        super().update(*args, **kwargs)
+
+    def clear(self) -> None:
+        self._blob = None
+        super().clear()
+
+    def __iter__(self):
+        self._load()
+        return super().__iter__()
+
+    def keys(self):
+        self._load()
+        return super().keys()
+
+    def items(self):
+        self._load()
+        return super().items()
+
+    def values(self):
+        self._load()
+        return super().values()
+
+    def __eq__(self, other) -> bool:
+        self._load()
+        if isinstance(other, LazyCheckpointItem):
+            other._load()
+        return super().__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        self._load()
+        return super().__repr__()
+
+    def copy(self) -> dict:
+        self._load()
+        return dict(super().items())
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo) -> dict:
+        return copy.deepcopy(self.copy(), memo)
+
+    def __reduce__(self):
+        return dict, (self.copy(),)
+
+
 class BaseCheckpointSaver(BaseModel):
     
     engine: Optional[Engine] = None
+    async_engine: Optional[AsyncEngine] = None
     Session: Optional[scoped_session] = None
     is_setup: bool = Field(default=False)
     session: Any = Field(default=None) 
+    serde: Any = Field(default=None)
+    cache: Any = Field(default=None)
+    writer: Any = Field(default=None)
 
     class Config:
         arbitrary_types_allowed = True
 
 class SQLAlchemyCheckpointSaver(BaseCheckpointSaver, AbstractContextManager):
-    
-    def __init__(self, engine: Engine, *, serde: Optional[Serializable] = None, at: Optional[CheckpointAt] = None):
+    """Checkpoints in a SQL table. The sync methods use engine, the async ones use async_engine when given
+    (without one they run the sync methods in the default executor).
+    With a LatestCheckpointCache, get_tuple of the latest checkpoint of a thread skips the checkpoint read.
+    With a CheckpointBatchWriter, put and aput are group committed with the puts of the other conversations."""
+
+    def __init__(self, engine: Engine, *, async_engine: Optional[AsyncEngine] = None,
+                 serde: Optional[SerializerProtocol] = None, cache: Optional[LatestCheckpointCache] = None,
+                 writer: Optional[CheckpointBatchWriter] = None):
         # Call super with all expected fields by Pydantic
-        super().__init__(serde=serde or pickle, at=at or CheckpointAt.END_OF_STEP, is_setup=False)
+        super().__init__(serde=serde or CheckpointSerializer.from_env(), is_setup=False)
         self.engine = engine
+        self.async_engine = async_engine
+        self.cache = cache
+        self.writer = writer
         self.Session = scoped_session(sessionmaker(bind=self.engine))
 
+    @staticmethod
+    def pool_options_from_env() -> dict:
+        return {
+            "pool_size": int(os.environ.get("CHECKPOINT_DB_POOL_SIZE", "10")),
+            "max_overflow": int(os.environ.get("CHECKPOINT_DB_MAX_OVERFLOW", "20")),
+            "pool_timeout": float(os.environ.get("CHECKPOINT_DB_POOL_TIMEOUT", "30")),
+            "pool_recycle": int(os.environ.get("CHECKPOINT_DB_POOL_RECYCLE", "1800")),
+            "pool_pre_ping": os.environ.get("CHECKPOINT_DB_POOL_PRE_PING", "true").lower() == "true",
+        }
 
     @classmethod
-    def from_db_config(cls, db_config):
+    def from_db_config(cls, db_config, **pool_options):
+        """Builds the sync engine, and the async one when an async driver is configured (db_config['async_drivername']
+        or CHECKPOINT_DB_ASYNC_DRIVERNAME, e.g. mssql+aioodbc), from the config.
+        pool_options (pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping) default to the
+        CHECKPOINT_DB_POOL_* environment variables. The latest checkpoint cache is set up from CHECKPOINT_CACHE_*
+        and the group commit from CHECKPOINT_GROUP_COMMIT*."""
         db_url = URL.create(
             drivername=db_config['drivername'],
             username=db_config['username'],
@@ -62,8 +400,20 @@ class SQLAlchemyCheckpointSaver(BaseCheckpointSaver, AbstractContextManager):
             database=db_config['database'],
             query=db_config['query']
         )
-        engine = create_engine(db_url)
-        return cls(engine)
+        pool_options = {**cls.pool_options_from_env(), **pool_options}
+        # The pool classes are explicit since some dialects (e.g. aiosqlite) default to no pooling
+        engine = create_engine(db_url, poolclass=QueuePool, **pool_options)
+        # The async engine is opt-in: its driver (see ASYNC_DRIVERS) is an extra dependency
+        async_drivername = db_config.get('async_drivername') or os.environ.get("CHECKPOINT_DB_ASYNC_DRIVERNAME")
+        async_engine = None
+        if async_drivername:
+            try:
+                async_engine = create_async_engine(db_url.set(drivername=async_drivername),
+                                                   poolclass=AsyncAdaptedQueuePool, **pool_options)
+            except ImportError as e:
+                logging.warning(f"No async engine for the checkpoints ({e}), the async methods use the executor")
+        return cls(engine, async_engine=async_engine, cache=LatestCheckpointCache.from_env(),
+                   writer=CheckpointBatchWriter.from_env(engine))
     
     def __enter__(self):
         self.session = self.Session()
@@ -86,109 +436,404 @@ class SQLAlchemyCheckpointSaver(BaseCheckpointSaver, AbstractContextManager):
             metadata.create_all(self.engine)
             self.is_setup = True
 
+    async def asetup(self):
+        if self.async_engine is None:
+            return self.setup()
+        if not self.is_setup:
+            async with self.async_engine.begin() as conn:
+                await conn.run_sync(metadata.create_all)
+            self.is_setup = True
+
+    async def aclose(self):
+        if self.writer is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.writer.close)
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+
+    @staticmethod
+    def _tuple_query(config: RunnableConfig):
+        thread_id = config["configurable"].get("thread_id")
+        thread_ts = config["configurable"].get("thread_ts")
+
+        query = select(checkpoints_table)
+        if thread_ts:
+            return query.where(
+                (checkpoints_table.c.thread_id == thread_id) &
+                (checkpoints_table.c.thread_ts == thread_ts)
+            )
+        return query.where(
+            checkpoints_table.c.thread_id == thread_id
+        ).order_by(checkpoints_table.c.thread_ts.desc()).limit(1)
+
+    def _to_tuple(self, config: RunnableConfig, result) -> CheckpointTuple:
+        return {
+            'config': config,
+            'checkpoint': self.serde.loads(result['checkpoint']),
+            'additional_info': {
+                "thread_id": result['thread_id'],
+                "thread_ts": result['parent_ts'] if result['parent_ts'] else None
+            }
+        }
+
+    @staticmethod
+    def _list_query(thread_id: str, before_ts: Optional[str], limit: int):
+        # Keyset pagination on the primary key, newest first
+        query = select(checkpoints_table).where(checkpoints_table.c.thread_id == thread_id)
+        if before_ts:
+            query = query.where(checkpoints_table.c.thread_ts < before_ts)
+        return query.order_by(checkpoints_table.c.thread_ts.desc()).limit(limit)
+
+    @staticmethod
+    def _before_ts(before: Union[RunnableConfig, str, None]) -> Optional[str]:
+        if isinstance(before, dict):
+            return before["configurable"].get("thread_ts")
+        return before
+
+    def _to_list_item(self, result) -> LazyCheckpointItem:
+        return LazyCheckpointItem(
+            result['checkpoint'],
+            self.serde,
+            configurable={
+                "thread_id": result['thread_id'],
+                "thread_ts": result['thread_ts']
+            },
+            additional_info={
+                "thread_id": result['thread_id'],
+                "thread_ts": result['parent_ts'] or None
+            }
+        )
+
+    @staticmethod
+    def _row(config: RunnableConfig, checkpoint: Checkpoint, blob: bytes) -> dict:
+        return {
+            "thread_id": config["configurable"]["thread_id"],
+            "thread_ts": checkpoint["ts"],
+            "parent_ts": config["configurable"].get("thread_ts"),
+            "checkpoint": blob
+        }
+
+    def _insert(self, config: RunnableConfig, checkpoint: Checkpoint, blob: bytes):
+        return checkpoints_table.insert().values(**self._row(config, checkpoint, blob))
+
+    @staticmethod
+    def _latest_ts_query(thread_id: str):
+        return select(checkpoints_table.c.thread_id, checkpoints_table.c.thread_ts).where(
+            checkpoints_table.c.thread_id == thread_id
+        ).order_by(checkpoints_table.c.thread_ts.desc()).limit(1)
+
+    @staticmethod
+    def _cached_tuple(config: RunnableConfig, entry: _CachedCheckpoint) -> CheckpointTuple:
+        return {
+            'config': config,
+            'checkpoint': entry.checkpoint,
+            'additional_info': {
+                "thread_id": config["configurable"].get("thread_id"),
+                "thread_ts": entry.parent_ts if entry.parent_ts else None
+            }
+        }
+
+    def _cache_lookup(self, config: RunnableConfig) -> Tuple[Optional[_CachedCheckpoint], bool]:
+        """(cached entry, whether it has to be checked against the table before use)"""
+        if self.cache is None:
+            return None, False
+        entry = self.cache.get(config["configurable"].get("thread_id"))
+        if entry is None:
+            return None, False
+        thread_ts = config["configurable"].get("thread_ts")
+        if thread_ts:
+            # A given version never changes
+            return (entry, False) if entry.thread_ts == thread_ts else (None, False)
+        return entry, not self.cache.is_fresh(entry)
+
+    def _cache_validated(self, entry: _CachedCheckpoint, latest) -> bool:
+        if latest is not None and latest[1] == entry.thread_ts:
+            self.cache.validated += 1
+            return True
+        self.cache.stale += 1
+        return False
+
+    def _cache_result(self, config: RunnableConfig, result, value: CheckpointTuple) -> None:
+        # Only the latest checkpoint of a thread is cached
+        if self.cache is not None and not config["configurable"].get("thread_ts"):
+            self.cache.store(result['thread_id'], result['thread_ts'], result['parent_ts'], value['checkpoint'],
+                             self._cached_size(result['checkpoint']))
+
+    def _cached_size(self, blob: bytes) -> int:
+        # Charged uncompressed, a compressed checkpoint is many times smaller than what the cache holds
+        if isinstance(self.serde, CheckpointSerializer):
+            return self.serde.raw_size(blob)
+        return len(blob)
+
+    def _cache_put(self, config: RunnableConfig, checkpoint: Checkpoint, blob: bytes) -> None:
+        if self.cache is not None:
+            self.cache.store(config["configurable"]["thread_id"], checkpoint["ts"],
+                             config["configurable"].get("thread_ts"), checkpoint, self._cached_size(blob))
+
+    @staticmethod
+    def _put_result(config: RunnableConfig, checkpoint: Checkpoint) -> RunnableConfig:
+        return {
+            "configurable": {
+                "thread_id": config["configurable"]["thread_id"],
+                "thread_ts": checkpoint["ts"]
+            }
+        }
+
     def get(self, config: RunnableConfig) -> Optional[Checkpoint]:
         if value := self.get_tuple(config):
             return value['checkpoint']
 
     def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
-        print("SQLAlchemyCheckpointSaver.get_tuple properly called")
-        with self.Session() as session:
-            thread_id = config["configurable"].get("thread_id")
-            thread_ts = config["configurable"].get("thread_ts")
-
-            query = select(checkpoints_table)
-            if thread_ts:
-                query = query.where(
-                    (checkpoints_table.c.thread_id == thread_id) &
-                    (checkpoints_table.c.thread_ts == thread_ts)
-                )
-            else:
-                query = query.where(
-                    checkpoints_table.c.thread_id == thread_id
-                ).order_by(checkpoints_table.c.thread_ts.desc()).limit(1)
-
-            result = session.execute(query).fetchone()
-            if result:
-                # Handling both potential types of result objects
-                if isinstance(result, tuple):
-                    # Convert tuple to dictionary using column keys if result is a tuple
-                    result = dict(zip(result.keys(), result))
-                elif hasattr(result, '_mapping'):
-                    # Convert SQLAlchemy RowProxy to dictionary directly if available
-                    result = dict(result._mapping)
-
-                return {
-                    'config': config,
-                    'checkpoint': pickle.loads(result['checkpoint']),
-                    'additional_info': {
-                        "thread_id": result['thread_id'],
-                        "thread_ts": result['parent_ts'] if result['parent_ts'] else None
-                    }
-                }
-            return None
+        entry, check = self._cache_lookup(config)
+        if entry is not None and not check:
+            return self._cached_tuple(config, entry)
 
+        with self.engine.connect() as conn:
+            if entry is not None:
+                latest = conn.execute(self._latest_ts_query(config["configurable"].get("thread_id"))).fetchone()
+                if self._cache_validated(entry, latest):
+                    return self._cached_tuple(config, entry)
+            result = conn.execute(self._tuple_query(config)).mappings().fetchone()
+        if not result:
+            return None
+        value = self._to_tuple(config, result)
+        self._cache_result(config, result, value)
+        return value
 
+    def list(self, config: RunnableConfig, *, limit: Optional[int] = None, before: Union[RunnableConfig, str, None] = None,
+             page_size: int = LIST_PAGE_SIZE) -> Iterator[LazyCheckpointItem]:
+        """Checkpoints of the thread, newest first, at most limit of them and only those older than before
+        (a config or a thread_ts). Rows are read page_size at a time as the iteration goes, no connection is
+        held between pages."""
+        self._check_page_size(page_size)
+        return self._list_pages(config, limit, before, page_size)
 
-    def list(self, config: RunnableConfig):
-        with self.Session() as session:
-            query = select(checkpoints_table).where(
-                checkpoints_table.c.thread_id == config["configurable"]["thread_id"]
-            ).order_by(checkpoints_table.c.thread_ts.desc())
-            results = session.execute(query).fetchall()
-
-            return [
-                {
-                    "configurable": {
-                        "thread_id": result['thread_id'],
-                        "thread_ts": result['thread_ts']
-                    },
-                    "checkpoint": pickle.loads(result['checkpoint']),
-                    "additional_info": {
-                        "thread_id": result['thread_id'],
-                        "thread_ts": result['parent_ts'] or None
-                    }
-                }
-                for result in results
-            ]
+    @staticmethod
+    def _check_page_size(page_size: int) -> None:
+        # Checked when list/alist is called, not when the iteration starts
+        if page_size < 1:
+            raise ValueError(f"page_size must be at least 1, got {page_size}")
 
+    def _list_pages(self, config: RunnableConfig, limit: Optional[int], before: Union[RunnableConfig, str, None],
+                    page_size: int) -> Iterator[LazyCheckpointItem]:
+        thread_id = config["configurable"]["thread_id"]
+        before_ts = self._before_ts(before)
+        while limit is None or limit > 0:
+            size = page_size if limit is None else min(page_size, limit)
+            with self.engine.connect() as conn:
+                results = conn.execute(self._list_query(thread_id, before_ts, size)).mappings().fetchall()
+            for result in results:
+                yield self._to_list_item(result)
+            if len(results) < size:
+                return
+            before_ts = results[-1]['thread_ts']
+            limit = None if limit is None else limit - len(results)
 
     def put(self, config: RunnableConfig, checkpoint: Checkpoint):
-        print("Attempting to connect with engine:", self.engine.url)  # Check the engine URL
+        blob = self.serde.dumps(checkpoint)
+        if self.writer is not None:
+            self.writer.submit(self._row(config, checkpoint, blob)).result()
+            self._cache_put(config, checkpoint, blob)
+            return self._put_result(config, checkpoint)
         with self.Session() as session:
-            print("Session started for put operation.")
             try:
-                session.execute(
-                    checkpoints_table.insert().values(
-                        thread_id=config["configurable"]["thread_id"],
-                        thread_ts=checkpoint["ts"],
-                        parent_ts=config["configurable"].get("thread_ts"),
-                        checkpoint=pickle.dumps(checkpoint)
-                    )
-                )
+                session.execute(self._insert(config, checkpoint, blob))
                 session.commit()
-                print("Data inserted and committed successfully.")
-            except Exception as e:
-                print("Error during database operation:", e)
+            except Exception:
+                logging.exception("Checkpoint insert failed")
                 session.rollback()
                 raise
-            finally:
-                print("Session closed after put operation.")
-        return {
-            "configurable": {
-                "thread_id": config["configurable"]["thread_id"],
-                "thread_ts": checkpoint["ts"]
-            }
-        }
+        self._cache_put(config, checkpoint, blob)
+        return self._put_result(config, checkpoint)
 
     async def aget(self, config: RunnableConfig) -> Optional[Checkpoint]:
-        return await asyncio.get_running_loop().run_in_executor(None, self.get, config)
+        if value := await self.aget_tuple(config):
+            return value['checkpoint']
 
     async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
-        return await asyncio.get_running_loop().run_in_executor(None, self.get_tuple, config)
+        if self.async_engine is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.get_tuple, config)
+        entry, check = self._cache_lookup(config)
+        if entry is not None and not check:
+            return self._cached_tuple(config, entry)
+
+        async with self.async_engine.connect() as conn:
+            if entry is not None:
+                latest = (await conn.execute(self._latest_ts_query(config["configurable"].get("thread_id")))).fetchone()
+                if self._cache_validated(entry, latest):
+                    return self._cached_tuple(config, entry)
+            result = (await conn.execute(self._tuple_query(config))).mappings().fetchone()
+        if not result:
+            return None
+        value = self._to_tuple(config, result)
+        self._cache_result(config, result, value)
+        return value
 
-    async def alist(self, config: RunnableConfig) -> Iterator[CheckpointTuple]:
-        return await asyncio.get_running_loop().run_in_executor(None, self.list, config)
+    def alist(self, config: RunnableConfig, *, limit: Optional[int] = None,
+              before: Union[RunnableConfig, str, None] = None,
+              page_size: int = LIST_PAGE_SIZE) -> AsyncIterator[LazyCheckpointItem]:
+        self._check_page_size(page_size)
+        return self._alist_pages(config, limit, before, page_size)
+
+    async def _alist_pages(self, config: RunnableConfig, limit: Optional[int], before: Union[RunnableConfig, str, None],
+                           page_size: int) -> AsyncIterator[LazyCheckpointItem]:
+        thread_id = config["configurable"]["thread_id"]
+        before_ts = self._before_ts(before)
+        while limit is None or limit > 0:
+            size = page_size if limit is None else min(page_size, limit)
+            query = self._list_query(thread_id, before_ts, size)
+            if self.async_engine is None:
+                results = await asyncio.get_running_loop().run_in_executor(None, self._fetch_all, query)
+            else:
+                async with self.async_engine.connect() as conn:
+                    results = (await conn.execute(query)).mappings().fetchall()
+            for result in results:
+                yield self._to_list_item(result)
+            if len(results) < size:
+                return
+            before_ts = results[-1]['thread_ts']
+            limit = None if limit is None else limit - len(results)
+
+    def _fetch_all(self, query) -> list:
+        with self.engine.connect() as conn:
+            return conn.execute(query).mappings().fetchall()
 
     async def aput(self, config: RunnableConfig, checkpoint: Checkpoint) -> RunnableConfig:
-        return await asyncio.get_running_loop().run_in_executor(None, self.put, config, checkpoint)
+        if self.async_engine is None and self.writer is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.put, config, checkpoint)
+        blob = self.serde.dumps(checkpoint)
+        if self.writer is not None:
+            # Awaiting the writer's future holds no executor thread
+            await asyncio.wrap_future(self.writer.submit(self._row(config, checkpoint, blob)))
+        else:
+            async with self.async_engine.begin() as conn:
+                await conn.execute(self._insert(config, checkpoint, blob))
+        self._cache_put(config, checkpoint, blob)
+        return self._put_result(config, checkpoint)
+
+    def _blob_length(self):
+        # SQL Server has no LENGTH for varbinary
+        if self.engine.dialect.name == "mssql":
+            return func.datalength(checkpoints_table.c.checkpoint)
+        return func.length(checkpoints_table.c.checkpoint)
+
+    def _delete_oldest(self, conn: Connection, thread_id: str, before_ts: str, limit: int) -> Tuple[int, int]:
+        """Deletes up to limit of the oldest checkpoints of a thread older than before_ts, returns (rows, bytes).
+        The rows are deleted as one primary key range, so only that range is locked."""
+        c = checkpoints_table.c
+        rows = conn.execute(
+            select(c.thread_ts, self._blob_length())
+            .where((c.thread_id == thread_id) & (c.thread_ts < before_ts))
+            .order_by(c.thread_ts).limit(limit)
+        ).fetchall()
+        if rows:
+            conn.execute(checkpoints_table.delete().where((c.thread_id == thread_id) & (c.thread_ts <= rows[-1][0])))
+        conn.commit()
+        return len(rows), sum(size or 0 for _, size in rows)
+
+    def _expired_threads(self, conn: Connection, cutoff: str, limit: int) -> List[str]:
+        c = checkpoints_table.c
+        threads = conn.execute(
+            select(c.thread_id).group_by(c.thread_id).having(func.max(c.thread_ts) < cutoff).order_by(c.thread_id).limit(limit)
+        ).scalars().all()
+        conn.commit()
+        return threads
+
+    def _trim_boundaries(self, conn: Connection, keep_last: int, limit: int) -> List[Tuple[str, str]]:
+        """(thread_id, thread_ts of its keep_last-th newest checkpoint) of threads with more checkpoints than that"""
+        c = checkpoints_table.c
+        threads = conn.execute(
+            select(c.thread_id).group_by(c.thread_id).having(func.count() > keep_last).order_by(c.thread_id).limit(limit)
+        ).scalars().all()
+        boundaries = []
+        for thread_id in threads:
+            boundary = conn.execute(
+                select(c.thread_ts).where(c.thread_id == thread_id)
+                .order_by(c.thread_ts.desc()).offset(keep_last - 1).limit(1)
+            ).scalar()
+            if boundary is not None:
+                boundaries.append((thread_id, boundary))
+        conn.commit()
+        return boundaries
+
+    def _compact(self, conn: Connection, policy: RetentionPolicy) -> dict:
+        report = {"rows_deleted": 0, "bytes_reclaimed": 0, "threads_expired": 0, "threads_trimmed": 0}
+        started = time.monotonic()
+
+        def delete_before(thread_id: str, before_ts: str) -> None:
+            while True:
+                rows, size = self._delete_oldest(conn, thread_id, before_ts, policy.batch_size)
+                report["rows_deleted"] += rows
+                report["bytes_reclaimed"] += size
+                COMPACTION_ROWS.inc(rows)
+                COMPACTION_BYTES.inc(size)
+                if rows < policy.batch_size:
+                    return
+
+        if policy.max_idle_days:
+            # Checkpoints written while the thread is deleted are newer than the cutoff and are kept
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=policy.max_idle_days)).isoformat()
+            while threads := self._expired_threads(conn, cutoff, policy.batch_size):
+                for thread_id in threads:
+                    delete_before(thread_id, cutoff)
+                report["threads_expired"] += len(threads)
 
+        if policy.keep_last:
+            while boundaries := self._trim_boundaries(conn, policy.keep_last, policy.batch_size):
+                for thread_id, boundary in boundaries:
+                    delete_before(thread_id, boundary)
+                report["threads_trimmed"] += len(boundaries)
+
+        report["seconds"] = round(time.monotonic() - started, 2)
+        return report
+
+    def compact(self, policy: Optional[RetentionPolicy] = None) -> dict:
+        """Applies the retention policy (RetentionPolicy.from_env() by default) to the checkpoints table.
+        Returns the rows and checkpoint bytes deleted, the space is reused or released by the database."""
+        with self.engine.connect() as conn:
+            return self._compact(conn, policy or RetentionPolicy.from_env())
+
+    async def acompact(self, policy: Optional[RetentionPolicy] = None) -> dict:
+        if self.async_engine is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.compact, policy)
+        async with self.async_engine.connect() as conn:
+            return await conn.run_sync(self._compact, policy or RetentionPolicy.from_env())
+
+    async def run_compaction(self, policy: Optional[RetentionPolicy] = None) -> None:
+        """Background job compacting the table every policy.interval seconds, meant for asyncio.create_task"""
+        policy = policy or RetentionPolicy.from_env()
+        while True:
+            try:
+                report = await self.acompact(policy)
+                if report["rows_deleted"]:
+                    logging.warning(f"Checkpoint compaction: {report}")
+            except Exception as e:
+                logging.warning(f"Checkpoint compaction failed: {e}")
+            await asyncio.sleep(policy.interval)
+
+    def migrate_checkpoints(self, batch_size: int = 500) -> int:
+        """Rewrites the checkpoints stored with pickle in the current format, returns how many were rewritten.
+        Rows are read in primary key order by batches, so the migration can run on a live table and be resumed."""
+        migrated = 0
+        last = None
+        while True:
+            with self.Session() as session:
+                query = select(checkpoints_table.c.thread_id, checkpoints_table.c.thread_ts, checkpoints_table.c.checkpoint)
+                if last is not None:
+                    # Row value comparison is not supported by SQL Server, the keyset condition is spelled out
+                    query = query.where((checkpoints_table.c.thread_id > last[0]) |
+                                        ((checkpoints_table.c.thread_id == last[0]) & (checkpoints_table.c.thread_ts > last[1])))
+                query = query.order_by(checkpoints_table.c.thread_id, checkpoints_table.c.thread_ts).limit(batch_size)
+                rows = session.execute(query).fetchall()
+                if not rows:
+                    return migrated
+                for thread_id, thread_ts, blob in rows:
+                    if blob is None or CheckpointSerializer.is_current(blob):
+                        continue
+                    session.execute(
+                        checkpoints_table.update()
+                        .where((checkpoints_table.c.thread_id == thread_id) & (checkpoints_table.c.thread_ts == thread_ts))
+                        .values(checkpoint=self.serde.dumps(self.serde.loads(blob)))
+                    )
+                    migrated += 1
+                session.commit()
+                last = (rows[-1][0], rows[-1][1])
@@ -0,0 +1,123 @@
+import os
+import threading
+
+from typing import Dict, List, Optional, Sequence
+
+import tiktoken
+
+from .cache import LRUCache
+
+
+DEFAULT_ENCODING = "cl100k_base"
+# Counts memoized per encoder, e.g. the history messages counted again on every turn. Only texts up to
+# TOKEN_COUNT_CACHE_MAX_CHARS are memoized, so the cache holds a few tens of MB at most
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", "4096"))
+TOKEN_COUNT_CACHE_MAX_CHARS = int(os.environ.get("TOKEN_COUNT_CACHE_MAX_CHARS", "8192"))
+# Threads used by tiktoken to encode a batch of texts
+TOKENIZER_THREADS = int(os.environ.get("TOKENIZER_THREADS", "8"))
+
+# Azure deployment names are free text, so the model is looked up inside them (most specific first)
+_MODEL_ENCODINGS = [
+    ("gpt-4o", "o200k_base"),
+    ("gpt-4", "cl100k_base"),
+    ("gpt-35-turbo", "cl100k_base"),
+    ("gpt-3.5-turbo", "cl100k_base"),
+    ("text-embedding-3", "cl100k_base"),
+    ("text-embedding-ada-002", "cl100k_base"),
+]
+
+# Loaded encodings by name, tiktoken.get_encoding is only called once per process for each
+_ENCODINGS: Dict[str, tiktoken.Encoding] = {}
+_tokenizers: Dict[str, "Tokenizer"] = {}
+_lock = threading.Lock()
+
+
+def encoding_name_for_model(model: Optional[str] = None) -> str:
+    """Name of the tiktoken encoding of a model or Azure deployment name, the chat deployment by default"""
+    model = model or os.environ.get("AZURE_OPENAI_TOKENIZER_MODEL") or os.environ.get("AZURE_OPENAI_MODEL_NAME") or ""
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        pass
+    name = model.lower()
+    for prefix, encoding_name in _MODEL_ENCODINGS:
+        if prefix in name:
+            return encoding_name
+    return DEFAULT_ENCODING
+
+
+def get_encoding(encoding_name: str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    encoding = _ENCODINGS.get(encoding_name)
+    if encoding is None:
+        with _lock:
+            encoding = _ENCODINGS.get(encoding_name) or tiktoken.get_encoding(encoding_name)
+            _ENCODINGS[encoding_name] = encoding
+    return encoding
+
+
+class Tokenizer:
+    """Token counting for one encoding, with the counts of recent texts memoized.
+    Special tokens appearing in the texts are counted as plain text."""
+
+    def __init__(self, encoding: tiktoken.Encoding, cache_size: int = TOKEN_COUNT_CACHE_SIZE,
+                 max_cached_chars: int = TOKEN_COUNT_CACHE_MAX_CHARS, num_threads: int = TOKENIZER_THREADS):
+        self.encoding = encoding
+        self.max_cached_chars = max_cached_chars
+        self.num_threads = num_threads
+        self._counts = LRUCache(max_size=cache_size)
+
+    @property
+    def name(self) -> str:
+        return self.encoding.name
+
+    def encode(self, text: str) -> List[int]:
+        return self.encoding.encode_ordinary(text)
+
+    def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+        return self.encoding.encode_ordinary_batch(list(texts), num_threads=self.num_threads)
+
+    def decode(self, tokens: Sequence[int]) -> str:
+        return self.encoding.decode(tokens)
+
+    def count(self, text: str) -> int:
+        if len(text) > self.max_cached_chars:
+            return len(self.encoding.encode_ordinary(text))
+        count = self._counts.get(text)
+        if count is None:
+            count = len(self.encoding.encode_ordinary(text))
+            self._counts.set(text, count)
+        return count
+
+    def count_batch(self, texts: Sequence[str]) -> List[int]:
+        """Counts of the texts, the ones not memoized are encoded together on tiktoken's threads"""
+        counts = [self._counts.get(text) if len(text) <= self.max_cached_chars else None for text in texts]
+        missing = list({text for text, count in zip(texts, counts) if count is None})
+        if missing:
+            found = dict(zip(missing, map(len, self.encode_batch(missing))))
+            for text, count in found.items():
+                if len(text) <= self.max_cached_chars:
+                    self._counts.set(text, count)
+            counts = [found[text] if count is None else count for text, count in zip(texts, counts)]
+        return counts
+
+    def stats(self) -> dict:
+        return self._counts.stats()
+
+
+def get_tokenizer(model: Optional[str] = None, encoding_name: Optional[str] = None) -> Tokenizer:
+    """Tokenizer of a model or deployment name (or of an encoding), one per encoding for the process"""
+    encoding_name = encoding_name or encoding_name_for_model(model)
+    tokenizer = _tokenizers.get(encoding_name)
+    if tokenizer is None:
+        encoding = get_encoding(encoding_name)
+        with _lock:
+            tokenizer = _tokenizers.setdefault(encoding_name, Tokenizer(encoding))
+    return tokenizer
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    return get_tokenizer(model).count(text)
+
+
+def count_tokens_batch(texts: Sequence[str], model: Optional[str] = None) -> List[int]:
+    return get_tokenizer(model).count_batch(texts)
@@ -0,0 +1,209 @@
+import os
+import time
+import logging
+import threading
+
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Iterator, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus sense, one series per label set"""
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series: Dict[Labels, list] = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            for bound, count in zip(self.buckets, values):
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', repr(bound)),))} {count}")
+            lines.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {values[-1]}")
+            lines.append(f"{self.name}_sum{_labels(key)} {values[-2]}")
+            lines.append(f"{self.name}_count{_labels(key)} {values[-1]}")
+        return "\n".join(lines)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._series: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = dict(self._series)
+        for key, value in sorted(series.items()):
+            lines.append(f"{self.name}{_labels(key)} {value}")
+        return "\n".join(lines)
+
+
+def _labels(key: Labels) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in key) + "}"
+
+
+class MetricsRegistry:
+    """Holds the process metrics and renders them in the Prometheus text format.
+    Collectors are functions returning a dict of numbers (e.g. cache stats), exported as gauges."""
+
+    def __init__(self, namespace: str = "nvt"):
+        self.namespace = namespace
+        self._metrics: Dict[str, Any] = {}
+        self._collectors: Dict[str, Callable[[], dict]] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(name, lambda full_name: Histogram(full_name, help, buckets))
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get_or_create(name, lambda full_name: Counter(full_name, help))
+
+    def _get_or_create(self, name: str, factory: Callable[[str], Any]) -> Any:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = factory(f"{self.namespace}_{name}")
+            return metric
+
+    def add_collector(self, name: str, collector: Callable[[], dict]) -> None:
+        self._collectors[name] = collector
+
+    def render(self) -> str:
+        parts = [metric.render() for metric in list(self._metrics.values())]
+        for name, collector in list(self._collectors.items()):
+            try:
+                values = collector()
+            except Exception as e:
+                logging.warning(f"Metrics collector {name} failed: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    full_name = f"{self.namespace}_{name}_{key}"
+                    parts.append(f"# TYPE {full_name} gauge\n{full_name} {value}")
+        return "\n".join(parts) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+STAGE_SECONDS = METRICS.histogram("stage_duration_seconds", "Duration of each stage of a turn")
+STAGE_ERRORS = METRICS.counter("stage_errors_total", "Stages that raised an exception")
+
+_tracer = trace.get_tracer("nvt-chatbot") if trace is not None else None
+
+
+def setup_opentelemetry(service_name: str = "nvt-chatbot") -> bool:
+    """Exports the spans with OTLP when OTEL_EXPORTER_OTLP_ENDPOINT is set and the OpenTelemetry SDK is installed"""
+    if trace is None or not os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return False
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError as e:
+        logging.warning(f"OpenTelemetry export disabled, missing package: {e}")
+        return False
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    return True
+
+
+@contextmanager
+def span(stage: str, **attributes: Any) -> Iterator[None]:
+    """Times a stage into the stage histogram, and into an OpenTelemetry span when it is installed.
+    Works around awaits too, the OpenTelemetry context is carried by contextvars."""
+    start = time.perf_counter()
+    with (_tracer.start_as_current_span(stage, attributes=attributes) if _tracer is not None else nullcontext()):
+        try:
+            yield
+        except BaseException:
+            STAGE_ERRORS.inc(stage=stage)
+            raise
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+class LLMTimingCallbackHandler(BaseCallbackHandler):
+    """Records the time to first token and the completion time of every LLM call"""
+
+    run_inline = True
+
+    def __init__(self) -> None:
+        self._runs: Dict[UUID, list] = {}  # run_id -> [start, first token seen, otel span]
+
+    def _start(self, run_id: UUID) -> None:
+        otel_span = _tracer.start_span("llm") if _tracer is not None else None
+        self._runs[run_id] = [time.perf_counter(), False, otel_span]
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.get(run_id)
+        if run is not None and not run[1]:
+            run[1] = True
+            observe_stage("llm_first_token", time.perf_counter() - run[0])
+            if run[2] is not None:
+                run[2].add_event("first_token")
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            observe_stage("llm_completion", time.perf_counter() - run[0])
+            if run[2] is not None:
+                run[2].end()
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            STAGE_ERRORS.inc(stage="llm_completion")
+            if run[2] is not None:
+                run[2].end()
@@ -1,20 +1,23 @@
 import re
 import os
 import json
+import mmap
+import tempfile
+import threading
 from io import BytesIO
 from typing import Any, Dict, List, Optional, Awaitable, Callable, Tuple, Type, Union
 import requests
+from requests.adapters import HTTPAdapter
 import asyncio
+import aiohttp
 import re
 
 from collections import OrderedDict
 import base64
 from bs4 import BeautifulSoup
 import docx2txt
-import tiktoken
 import html
 import time
-from time import sleep
 from typing import List, Tuple
 from pypdf import PdfReader, PdfWriter
 from dataclasses import dataclass
@@ -26,7 +29,7 @@ from langchain.callbacks.manager import AsyncCallbackManagerForToolRun, Callback
 from langchain.pydantic_v1 import BaseModel, Field, Extra
 from langchain.tools import BaseTool, StructuredTool, tool
 from typing import Dict, List
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import BaseOutputParser, OutputParserException
 from langchain.chains import LLMChain
@@ -51,13 +54,25 @@ from langchain_openai import AzureOpenAIEmbeddings
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.retrievers import BaseRetriever
-from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
 from langchain_core.documents import Document
 from operator import itemgetter
 from typing import List
 
 
 
+try:
+    from .cache import LRUCache
+    from .tracing import span
+    from .ratelimit import rate_limited
+    from .tokenizer import get_tokenizer
+except Exception as e:
+    print(e)
+    from cache import LRUCache
+    from tracing import span
+    from ratelimit import rate_limited
+    from tokenizer import get_tokenizer
+
 try:
     from .prompts import (AGENT_DOCSEARCH_PROMPT, CSV_PROMPT_PREFIX, MSSQL_AGENT_PREFIX,
                           CHATGPT_PROMPT, BINGSEARCH_PROMPT, APISEARCH_PROMPT)
@@ -79,34 +94,162 @@ def text_to_base64(text):
 
     return base64_text
 
+# Timeout (seconds) of every Azure AI Search request and size of the keep-alive connection pools
+SEARCH_TIMEOUT = float(os.environ.get("AZURE_SEARCH_TIMEOUT", "10"))
+SEARCH_MAX_CONNECTIONS = int(os.environ.get("AZURE_SEARCH_MAX_CONNECTIONS", "20"))
+
+# One requests session (keep-alive connection pool) and one thread pool for the sync HTTP calls of the process
+_requests_session: Optional[requests.Session] = None
+_search_executor: Optional[ThreadPoolExecutor] = None
+# Guards the creation of the shared clients, so concurrent first calls do not create (and leak) one each
+_clients_lock = threading.Lock()
+
+def get_requests_session() -> requests.Session:
+    """Returns the shared requests session, creating it on first use"""
+    global _requests_session
+    if _requests_session is None:
+        with _clients_lock:
+            if _requests_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=SEARCH_MAX_CONNECTIONS, pool_maxsize=SEARCH_MAX_CONNECTIONS)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _requests_session = session
+    return _requests_session
+
+def get_search_executor() -> ThreadPoolExecutor:
+    """Returns the shared thread pool used to fan out the sync search requests"""
+    global _search_executor
+    if _search_executor is None:
+        with _clients_lock:
+            if _search_executor is None:
+                _search_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_CONNECTIONS, thread_name_prefix="search")
+    return _search_executor
+
+# One aiohttp session (connection pool) per event loop, shared by all the async HTTP calls of the process
+_aiohttp_sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+def get_aiohttp_session() -> aiohttp.ClientSession:
+    """Returns the shared aiohttp session of the running event loop, creating it on first use"""
+    loop = asyncio.get_running_loop()
+    session = _aiohttp_sessions.get(loop)
+    if session is None or session.closed:
+        with _clients_lock:
+            session = _aiohttp_sessions.get(loop)
+            if session is None or session.closed:
+                session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=SEARCH_MAX_CONNECTIONS),
+                                                timeout=aiohttp.ClientTimeout(total=SEARCH_TIMEOUT))
+                _aiohttp_sessions[loop] = session
+    return session
+
+async def close_aiohttp_session() -> None:
+    """Closes the shared aiohttp session of the running event loop (call it on shutdown)"""
+    session = _aiohttp_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
 def table_to_html(table):
-    table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    # Cells grouped by row in one pass, in document order within a row before sorting by column (as before)
+    rows = [[] for _ in range(table.row_count)]
+    for cell in table.cells:
+        if 0 <= cell.row_index < table.row_count:
+            rows[cell.row_index].append(cell)
+    parts = ["<table>"]
     for row_cells in rows:
-        table_html += "<tr>"
-        for cell in row_cells:
+        parts.append("<tr>")
+        for cell in sorted(row_cells, key=lambda cell: cell.column_index):
             tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
             cell_spans = ""
             if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
             if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
-
-
-def parse_pdf(file, form_recognizer=False, formrecognizer_endpoint=None, formrecognizerkey=None, model="prebuilt-document", from_url=False, verbose=False):
-    """Parses PDFs using PyPDF or Azure Document Intelligence SDK (former Azure Form Recognizer)"""
+            parts.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+        parts.append("</tr>")
+    parts.append("</table>")
+    return "".join(parts)
+
+
+def _page_segments(page_offset, page_length, tables_on_page):
+    """Splits a page in (start, end, table_id) segments, table_id -1 for plain text.
+    Where table spans overlap the last table wins, like painting them in order character by character."""
+    events = []
+    for table_id, table in enumerate(tables_on_page):
+        for table_span in table.spans:
+            start = max(table_span.offset - page_offset, 0)
+            end = min(table_span.offset - page_offset + table_span.length, page_length)
+            if start < end:
+                events.append((start, 1, table_id))
+                events.append((end, -1, table_id))
+    if not events:
+        return [(0, page_length, -1)] if page_length > 0 else []
+    events.sort()
+
+    segments = []
+    active = {}  # table_id -> number of its spans covering the current position
+    position = 0
+    for point, kind, table_id in events:
+        if point > position:
+            owner = max(active) if active else -1
+            if segments and segments[-1][2] == owner and segments[-1][1] == position:
+                segments[-1] = (segments[-1][0], point, owner)
+            else:
+                segments.append((position, point, owner))
+            position = point
+        if kind == 1:
+            active[table_id] = active.get(table_id, 0) + 1
+        else:
+            active[table_id] -= 1
+            if not active[table_id]:
+                del active[table_id]
+    if position < page_length:
+        segments.append((position, page_length, -1))
+    return segments
+
+
+def iter_form_recognizer_pages(form_recognizer_results, offset=0):
+    """Yields (page_num, offset, page_text) of a Document Intelligence result, the tables replaced by their html"""
+    content = form_recognizer_results.content
+    tables_by_page = {}
+    for table in form_recognizer_results.tables:
+        tables_by_page.setdefault(table.bounding_regions[0].page_number, []).append(table)
+
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = tables_by_page.get(page_num + 1, [])
+
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+
+        # build page text by replacing the table spans with the table html
+        parts = []
+        added_tables = set()
+        for start, end, table_id in _page_segments(page_offset, page_length, tables_on_page):
+            if table_id == -1:
+                parts.append(content[page_offset + start:page_offset + end])
+            elif not table_id in added_tables:
+                parts.append(table_to_html(tables_on_page[table_id]))
+                added_tables.add(table_id)
+
+        page_text = "".join(parts) + " "
+        yield (page_num, offset, page_text)
+        offset += len(page_text)
+
+
+def build_form_recognizer_page_map(form_recognizer_results, offset=0):
+    """Builds the page_map of a Document Intelligence result"""
+    return list(iter_form_recognizer_pages(form_recognizer_results, offset))
+
+
+def iter_pdf_pages(file, form_recognizer=False, formrecognizer_endpoint=None, formrecognizerkey=None, model="prebuilt-document", from_url=False, verbose=False):
+    """Yields (page_num, offset, page_text) one page at a time, as parse_pdf returns them.
+    With PyPDF a local file (path) is read through a read-only memory map and only the page being extracted
+    is kept in memory, so the memory used does not grow with the size of the document."""
     offset = 0
-    page_map = []
     if not form_recognizer:
         if verbose: print(f"Extracting text using PyPDF")
-        reader = PdfReader(file)
-        pages = reader.pages
-        for page_num, p in enumerate(pages):
-            page_text = p.extract_text()
-            page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield from _iter_pypdf_pages(mapped)
+        else:
+            yield from _iter_pypdf_pages(file)
     else:
         if verbose: print(f"Extracting text using Azure Document Intelligence")
         credential = AzureKeyCredential(os.environ["FORM_RECOGNIZER_KEY"])
@@ -119,66 +262,207 @@ def parse_pdf(file, form_recognizer=False, formrecognizer_endpoint=None, formrec
             poller = form_recognizer_client.begin_analyze_document_from_url(model, document_url = file)
             
         form_recognizer_results = poller.result()
+        yield from iter_form_recognizer_pages(form_recognizer_results, offset)
+
+
+def _iter_pypdf_pages(stream):
+    offset = 0
+    reader = PdfReader(stream)
+    for page_num in range(len(reader.pages)):
+        page_text = reader.pages[page_num].extract_text()
+        # Drop the objects parsed for this page (content streams, fonts...), they are read again from the file if needed
+        reader.resolved_objects.clear()
+        yield (page_num, offset, page_text)
+        offset += len(page_text)
+
+
+def parse_pdf(file, form_recognizer=False, formrecognizer_endpoint=None, formrecognizerkey=None, model="prebuilt-document", from_url=False, verbose=False):
+    """Parses PDFs using PyPDF or Azure Document Intelligence SDK (former Azure Form Recognizer)"""
+    return list(iter_pdf_pages(file, form_recognizer=form_recognizer, formrecognizer_endpoint=formrecognizer_endpoint, formrecognizerkey=formrecognizerkey,
+                               model=model, from_url=from_url, verbose=verbose))
+
+
+# Parallel ingestion (opt-in): number of worker processes (1 = sequential, 0 = one per CPU) and pages of a big PDF
+# parsed by one task
+PDF_INGEST_WORKERS = int(os.environ.get("PDF_INGEST_WORKERS", "1"))
+PDF_PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", "50"))
+
+
+def _pdf_name(file) -> str:
+    return file if isinstance(file, str) else file.name
+
+
+def _local_pdf_path(file, temp_files: List[str]) -> str:
+    """Path of a PDF the worker processes can open, an uploaded file is written once to a temporary file"""
+    if isinstance(file, (str, os.PathLike)):
+        return os.fspath(file)
+    if hasattr(file, "seek"):
+        file.seek(0)
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        temp_files.append(f.name)
+        for block in iter(lambda: file.read(1 << 20), b""):
+            f.write(block)
+    return f.name
+
+
+def _count_pdf_pages(path: str) -> int:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return len(PdfReader(mapped).pages)
+
+
+def _extract_pdf_pages(path: str, start: int, stop: int) -> List[str]:
+    """Runs in a worker process: text of the pages [start, stop) of a PDF, same extraction as parse_pdf.
+    The task only carries the path, the file is memory mapped by the worker."""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        pages = PdfReader(mapped).pages
+        return [pages[page_num].extract_text() for page_num in range(start, stop)]
+
+
+def read_pdf_files(files, form_recognizer=False, verbose=False, formrecognizer_endpoint=None, formrecognizerkey=None,
+                   max_workers=None, pages_per_task=None, progress_callback=None):
+    """This function will go through pdf and extract and return list of page texts (chunks).
+
+    Files are parsed one after another unless max_workers (or PDF_INGEST_WORKERS) is not 1: then PyPDF runs in a
+    process pool (big PDFs are split in ranges of pages_per_task pages) and Document Intelligence in threads.
+    The output keeps the order of the files and pages. A file that fails is reported and left out, the others
+    are still returned. progress_callback(files_done, files_total, file_name, error) is called after every file."""
+    if max_workers is None:
+        max_workers = PDF_INGEST_WORKERS
+    max_workers = max_workers or os.cpu_count() or 1
+    pages_per_task = pages_per_task or PDF_PAGES_PER_TASK
+    files = list(files)
+    results = [None] * len(files)  # page texts of every file, None when it failed
+    done = [0]
+
+    def report(i, error=None):
+        done[0] += 1
+        if error is not None:
+            print(f"Could not parse {_pdf_name(files[i])}: {error}")
+        elif verbose:
+            print(f"Parsed {done[0]}/{len(files)} files: {_pdf_name(files[i])} ({len(results[i])} pages)")
+        if progress_callback is not None:
+            progress_callback(done[0], len(files), _pdf_name(files[i]), error)
+
+    if form_recognizer or max_workers == 1:
+        def parse(i):
+            page_map = parse_pdf(files[i], form_recognizer=form_recognizer, verbose=verbose, formrecognizer_endpoint=formrecognizer_endpoint, formrecognizerkey=formrecognizerkey)
+            return [page[2] for page in page_map]
+
+        if max_workers == 1:
+            for i in range(len(files)):
+                try:
+                    results[i] = parse(i)
+                except Exception as e:
+                    report(i, e)
+                else:
+                    report(i)
+        else:
+            # Document Intelligence does the work remotely, threads are enough
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(parse, i): i for i in range(len(files))}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        results[i] = future.result()
+                    except Exception as e:
+                        report(i, e)
+                    else:
+                        report(i)
+    else:
+        temp_files = []  # uploaded files written to disk for the workers, removed at the end
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {}
+                pending = [0] * len(files)  # page ranges still running per file
+                parts = [dict() for _ in files]  # start page -> page texts
+                for i, file in enumerate(files):
+                    try:
+                        path = _local_pdf_path(file, temp_files)
+                        page_count = _count_pdf_pages(path)
+                    except Exception as e:
+                        report(i, e)
+                        continue
+                    for start in range(0, page_count, pages_per_task):
+                        futures[executor.submit(_extract_pdf_pages, path, start, min(start + pages_per_task, page_count))] = (i, start)
+                        pending[i] += 1
+                    if not page_count:
+                        results[i] = []
+                        report(i)
+                for future in as_completed(futures):
+                    i, start = futures[future]
+                    if parts[i] is None:
+                        continue  # another range of this file already failed
+                    try:
+                        parts[i][start] = future.result()
+                    except Exception as e:
+                        parts[i] = None
+                        report(i, e)
+                        continue
+                    pending[i] -= 1
+                    if not pending[i]:
+                        results[i] = [text for start in sorted(parts[i]) for text in parts[i][start]]
+                        report(i)
+        finally:
+            for path in temp_files:
+                os.remove(path)
 
-        for page_num, page in enumerate(form_recognizer_results.pages):
-            tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-            # mark all positions of the table spans in the page
-            page_offset = page.spans[0].offset
-            page_length = page.spans[0].length
-            table_chars = [-1]*page_length
-            for table_id, table in enumerate(tables_on_page):
-                for span in table.spans:
-                    # replace all table spans with "table_id" in table_chars array
-                    for i in range(span.length):
-                        idx = span.offset - page_offset + i
-                        if idx >=0 and idx < page_length:
-                            table_chars[idx] = table_id
-
-            # build page text by replacing charcters in table spans with table html
-            page_text = ""
-            added_tables = set()
-            for idx, table_id in enumerate(table_chars):
-                if table_id == -1:
-                    page_text += form_recognizer_results.content[page_offset + idx]
-                elif not table_id in added_tables:
-                    page_text += table_to_html(tables_on_page[table_id])
-                    added_tables.add(table_id)
-
-            page_text += " "
-            page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
-
-    return page_map    
-
-
-def read_pdf_files(files, form_recognizer=False, verbose=False, formrecognizer_endpoint=None, formrecognizerkey=None):
-    """This function will go through pdf and extract and return list of page texts (chunks)."""
     text_list = []
     sources_list = []
-    for file in files:
-        page_map = parse_pdf(file, form_recognizer=form_recognizer, verbose=verbose, formrecognizer_endpoint=formrecognizer_endpoint, formrecognizerkey=formrecognizerkey)
-        for page in enumerate(page_map):
-            text_list.append(page[1][2])
-            sources_list.append(file.name + "_page_"+str(page[1][0]+1))
+    for file, page_texts in zip(files, results):
+        for page_num, page_text in enumerate(page_texts or []):
+            text_list.append(page_text)
+            sources_list.append(_pdf_name(file) + "_page_"+str(page_num+1))
     return [text_list,sources_list]
     
     
 
 # Returns the num of tokens used on a string
-def num_tokens_from_string(string: str) -> int:
-    encoding_name ='cl100k_base'
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+def num_tokens_from_string(string: str, encoding_name: Optional[str] = None, model: Optional[str] = None) -> int:
+    """Returns the number of tokens in a text string, for the chat deployment unless a model or encoding is given."""
+    return get_tokenizer(model, encoding_name).count(string)
 
 # Returns num of toknes used on a list of Documents objects
-def num_tokens_from_docs(docs: List[Document]) -> int:
-    num_tokens = 0
-    for i in range(len(docs)):
-        num_tokens += num_tokens_from_string(docs[i].page_content)
-    return num_tokens
+def num_tokens_from_docs(docs: List[Document], model: Optional[str] = None) -> int:
+    return sum(get_tokenizer(model).count_batch([doc.page_content for doc in docs]))
+
+
+def pack_documents(docs: List[Document], max_tokens: int, min_truncated_tokens: int = 100,
+                   encoding_name: Optional[str] = None, model: Optional[str] = None,
+                   render: Optional[Callable[[Document], str]] = None) -> Tuple[List[Document], int, int]:
+    """Keeps the documents (expected in score order) that fit in max_tokens.
+    The first one that does not fit is truncated if at least min_truncated_tokens are left, the rest is dropped.
+    Documents are counted as render(doc) shows them in the prompt (metadata included), their page_content if
+    render is not given. Returns (packed documents, tokens kept, tokens dropped)."""
+    tokenizer = get_tokenizer(model, encoding_name)
+    render = render or (lambda doc: doc.page_content)
+    packed = []
+    kept = dropped = 0
+    for doc, count in zip(docs, tokenizer.count_batch([render(doc) for doc in docs])):
+        left = max_tokens - kept
+        if count <= left:
+            packed.append(doc)
+            kept += count
+            continue
+        truncated, truncated_count = None, 0
+        if left >= min_truncated_tokens:
+            tokens = tokenizer.encode(doc.page_content)
+            # The rendered metadata is not truncated, the content gets what is left after it
+            keep = left - tokenizer.count(render(Document(page_content="", metadata=doc.metadata)))
+            while keep > 0:
+                truncated = Document(page_content=tokenizer.decode(tokens[:keep]), metadata=doc.metadata)
+                truncated_count = tokenizer.count(render(truncated))
+                if truncated_count <= left:
+                    break
+                keep -= truncated_count - left
+                truncated = None
+        if truncated is not None:
+            packed.append(truncated)
+            kept += truncated_count
+            dropped += count - truncated_count
+        else:
+            dropped += count
+        max_tokens = kept  # Nothing else fits, the remaining documents are only counted
+    return packed, kept, dropped
 
 
 @dataclass(frozen=True)
@@ -260,64 +544,141 @@ def extract_file_info(file_path):
     else:
         return None
 
-def get_next_page(headers, params, file_name, file_number, sas_token, score, index):
+def _search_url(index: str) -> str:
+    return os.environ['AZURE_SEARCH_ENDPOINT'] + "/indexes/" + index + "/docs/search"
 
-    search_payload = {
-        "filter": f"title eq '{file_name}.pdf_page_{file_number}_chunk_0'",
+
+def _next_pages_payload(titles: List[str]) -> dict:
+    """One query for all the next pages wanted from an index"""
+    escaped = [title.replace("'", "''") for title in titles]
+    if any("|" in title for title in titles):
+        search_filter = " or ".join(f"title eq '{title}'" for title in escaped)
+    else:
+        search_filter = "search.in(title, '" + "|".join(escaped) + "', '|')"
+    return {
+        "filter": search_filter,
+        "select": "id, title, chunk, name, location",
+        "top": len(titles),
     }
 
-    resp = requests.post(os.environ['AZURE_SEARCH_ENDPOINT'] + "/indexes/" + index + "/docs/search",
-                             data=json.dumps(search_payload), headers=headers, params=params)
 
-    if resp.json()["value"]:
-        next_page = resp.json()["value"][0]
+def _next_page_result(next_page, sas_token, score, index):
+    return {
+        "title": next_page['title'], 
+        "name": next_page['name'], 
+        "chunk": next_page['chunk'],
+        "location": next_page['location'] + sas_token if next_page['location'] else "",
+        "caption": "",
+        "score": score,
+        "index": index
+    }
+
+
+def _post_search(index: str, payload: dict, headers: dict, params: dict) -> dict:
+    with span("search_request", index=index):
+        resp = get_requests_session().post(_search_url(index), data=json.dumps(payload), headers=headers, params=params, timeout=SEARCH_TIMEOUT)
+        resp.raise_for_status()
+        return resp.json()
+
+
+async def _apost_search(index: str, payload: dict, headers: dict, params: dict) -> dict:
+    with span("search_request", index=index):
+        async with get_aiohttp_session().post(_search_url(index), data=json.dumps(payload), headers=headers, params=params) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+
+def _select_top_hits(content: dict, topk: int) -> List[Tuple[str, str]]:
+    """Returns (id, title of the next page) of the best hit of each page, in score order, up to topk"""
+    selected = []
+    duplicate_guard = set()
+    for id in sorted(content, key=lambda x: content[x]["score"], reverse=True):
+
+        file_name, file_number = extract_file_info(content[id]["title"])
+        path_to_check = f"{file_name}_{file_number}"
         
-        result = {
-            "title": next_page['title'], 
-            "name": next_page['name'], 
-            "chunk": next_page['chunk'],
-            "location": next_page['location'] + sas_token if next_page['location'] else "",
-            "caption": "",
-            "score": score,
-            "index": index
-        }
-    
-        return next_page["id"], result
-    else:
-        return None, None
+        if not(path_to_check in duplicate_guard):
+            selected.append((id, f"{file_name}.pdf_page_{file_number+1}_chunk_0"))
+            duplicate_guard.add(path_to_check)
+            if len(selected) >= topk:  # Stop after adding topK results
+                break
+    return selected
 
-def get_search_results(query: str, indexes: list, 
-                       k: int = 20,
-                       reranker_threshold: int = 1,
-                       sas_token: str = "") -> List[dict]:
-    """Performs multi-index hybrid search and returns ordered dictionary with the combined results"""
-    
+
+def _next_pages_wanted(content: dict, selected: List[Tuple[str, str]]) -> Dict[str, List[str]]:
+    wanted = dict()
+    for id, next_title in selected:
+        wanted.setdefault(content[id]["index"], []).append(next_title)
+    return wanted
+
+
+def _next_pages_by_title(responses: List[Tuple[str, dict]]) -> Dict[Tuple[str, str], dict]:
+    next_pages = dict()
+    for index, search_results in responses:
+        for next_page in search_results["value"]:
+            next_pages.setdefault((index, next_page["title"]), next_page)
+    return next_pages
+
+
+def get_next_pages(headers, params, wanted: Dict[str, List[str]]) -> Dict[Tuple[str, str], dict]:
+    """Fetches the next pages of all the hits with one request per index, keyed by (index, title)"""
+
+    def fetch(index):
+        return index, _post_search(index, _next_pages_payload(wanted[index]), headers, params)
+
+    with span("search_expansion"):
+        if len(wanted) <= 1:
+            responses = [fetch(index) for index in wanted]
+        else:
+            responses = list(get_search_executor().map(fetch, wanted))
+    return _next_pages_by_title(responses)
+
+
+async def aget_next_pages(headers, params, wanted: Dict[str, List[str]]) -> Dict[Tuple[str, str], dict]:
+    """Async version of get_next_pages using the shared aiohttp session"""
+
+    async def fetch(index):
+        return index, await _apost_search(index, _next_pages_payload(wanted[index]), headers, params)
+
+    with span("search_expansion"):
+        responses = await asyncio.gather(*(fetch(index) for index in wanted))
+    return _next_pages_by_title(responses)
+
+
+def _merge_next_pages(content: dict, selected: List[Tuple[str, str]], next_pages: dict, sas_token: str) -> OrderedDict:
+    """Puts every hit followed by its next page (which gets the score of the hit), in score order"""
+    ordered_content = OrderedDict()
+    for id, next_title in selected:
+        ordered_content[id] = content[id]
+        index = content[id]["index"]
+        next_page = next_pages.get((index, next_title))
+        if next_page is not None:
+            ordered_content[next_page["id"]] = _next_page_result(next_page, sas_token, content[id]["score"], index)
+    return ordered_content
+
+
+def _search_payload(query: str, k: int) -> dict:
+    return {
+        "search": query,
+        "select": "id, title, chunk, name, location",
+        "queryType": "semantic",
+        "vectorQueries": [{"text": query, "fields": "chunkVector", "kind": "text", "k": k}],
+        "semanticConfiguration": "my-semantic-config",
+        "captions": "extractive",
+        "answers": "extractive",
+        "count":"true",
+        "top": k    
+    }
+
+
+def _search_headers_and_params() -> Tuple[dict, dict]:
     headers = {'Content-Type': 'application/json','api-key': os.environ["AZURE_SEARCH_KEY"]}
     params = {'api-version': os.environ['AZURE_SEARCH_API_VERSION']}
+    return headers, params
 
-    agg_search_results = dict()
-    
-    for index in indexes:
-        search_payload = {
-            "search": query,
-            "select": "id, title, chunk, name, location",
-            "queryType": "semantic",
-            "vectorQueries": [{"text": query, "fields": "chunkVector", "kind": "text", "k": k}],
-            "semanticConfiguration": "my-semantic-config",
-            "captions": "extractive",
-            "answers": "extractive",
-            "count":"true",
-            "top": k    
-        }
-
-        resp = requests.post(os.environ['AZURE_SEARCH_ENDPOINT'] + "/indexes/" + index + "/docs/search",
-                         data=json.dumps(search_payload), headers=headers, params=params)
 
-        search_results = resp.json()
-        agg_search_results[index] = search_results
-    
+def _filter_search_results(agg_search_results: dict, reranker_threshold: int, sas_token: str) -> dict:
     content = dict()
-    ordered_content = OrderedDict()
     
     for index,search_results in agg_search_results.items():
         for result in search_results['value']:
@@ -331,46 +692,162 @@ def get_search_results(query: str, indexes: list,
                                         "score": result['@search.rerankerScore'],
                                         "index": index
                                     }
-                
+    return content
 
-    topk = k
-    duplicate_guard = {}
-        
-    count = 0  # To keep track of the number of results added
-    for id in sorted(content, key=lambda x: content[x]["score"], reverse=True):
 
-        file_name, file_number = extract_file_info(content[id]["title"])
-        path_to_check = f"{file_name}_{file_number}"
-        
-        if not(path_to_check in duplicate_guard):
-            ordered_content[id] = content[id]
-
-            next_page_id, next_page_content = get_next_page(headers, params, file_name, file_number+1, sas_token, content[id]["score"], index)
-            if next_page_content is not None:
-                ordered_content[next_page_id] = next_page_content
-            duplicate_guard[path_to_check] = "existed"
-            count += 1
-            if count >= topk:  # Stop after adding topK results
-                break
+# Separator used by the bot to append the activity metadata to the question, never searched nor part of a cache key
+METADATA_SEPARATOR = "\n\n metadata:\n"
+
+
+def strip_question_metadata(question: str) -> str:
+    return question.split(METADATA_SEPARATOR, 1)[0]
+
+
+def normalize_question(question: str) -> str:
+    """Removes the metadata suffix, case and extra whitespace from a question"""
+    return " ".join(strip_question_metadata(question).lower().split())
+
+
+# Cache of get_search_results, identical queries within the TTL skip Azure AI Search
+SEARCH_CACHE = LRUCache(max_size=int(os.environ.get("SEARCH_CACHE_SIZE", "512")),
+                        ttl=float(os.environ.get("SEARCH_CACHE_TTL", "300")))
+
+def _search_cache_key(query: str, indexes: list, k: int, reranker_threshold: int, sas_token: str) -> tuple:
+    return (normalize_question(query), tuple(indexes), k, reranker_threshold, sas_token)
+
+def _copy_results(results: dict) -> OrderedDict:
+    # The cached results are shared between turns, callers get their own result dicts
+    return OrderedDict((key, dict(value)) for key, value in results.items())
+
+def invalidate_search_cache(index: Optional[str] = None) -> int:
+    """Drops the cached search results of one index (or of all indexes), returns how many were dropped"""
+    if index is None:
+        count = len(SEARCH_CACHE)
+        SEARCH_CACHE.clear()
+        return count
+    return SEARCH_CACHE.discard_where(lambda key: index in key[1])
+
+def search_cache_stats() -> dict:
+    return SEARCH_CACHE.stats()
 
+
+def get_search_results(query: str, indexes: list, 
+                       k: int = 20,
+                       reranker_threshold: int = 1,
+                       sas_token: str = "",
+                       use_cache: bool = True) -> List[dict]:
+    """Performs multi-index hybrid search and returns ordered dictionary with the combined results"""
+    
+    query = strip_question_metadata(query)
+    cache_key = _search_cache_key(query, indexes, k, reranker_threshold, sas_token)
+    if use_cache:
+        cached = SEARCH_CACHE.get(cache_key)
+        if cached is not None:
+            return _copy_results(cached)
+
+    headers, params = _search_headers_and_params()
+    payload = _search_payload(query, k)
+
+    # Query all the indexes concurrently over the shared keep-alive session
+    if len(indexes) == 1:
+        agg_search_results = {indexes[0]: _post_search(indexes[0], payload, headers, params)}
+    else:
+        results = get_search_executor().map(lambda index: _post_search(index, payload, headers, params), indexes)
+        agg_search_results = dict(zip(indexes, results))
+    
+    content = _filter_search_results(agg_search_results, reranker_threshold, sas_token)
+    selected = _select_top_hits(content, k)
+
+    # Expand every hit with its next page, one batched request per index
+    next_pages = get_next_pages(headers, params, _next_pages_wanted(content, selected))
+    ordered_content = _merge_next_pages(content, selected, next_pages, sas_token)
+
+    if use_cache:
+        SEARCH_CACHE.set(cache_key, _copy_results(ordered_content))
+    return ordered_content
+
+
+async def aget_search_results(query: str, indexes: list, 
+                              k: int = 20,
+                              reranker_threshold: int = 1,
+                              sas_token: str = "",
+                              use_cache: bool = True) -> List[dict]:
+    """Async version of get_search_results, the requests go through the shared aiohttp session"""
+    
+    query = strip_question_metadata(query)
+    cache_key = _search_cache_key(query, indexes, k, reranker_threshold, sas_token)
+    if use_cache:
+        cached = SEARCH_CACHE.get(cache_key)
+        if cached is not None:
+            return _copy_results(cached)
+
+    headers, params = _search_headers_and_params()
+    payload = _search_payload(query, k)
+
+    # Query all the indexes concurrently over the shared aiohttp session
+    results = await asyncio.gather(*(_apost_search(index, payload, headers, params) for index in indexes))
+    agg_search_results = dict(zip(indexes, results))
+    
+    content = _filter_search_results(agg_search_results, reranker_threshold, sas_token)
+    selected = _select_top_hits(content, k)
+
+    # Expand every hit with its next page, one batched request per index
+    next_pages = await aget_next_pages(headers, params, _next_pages_wanted(content, selected))
+    ordered_content = _merge_next_pages(content, selected, next_pages, sas_token)
+
+    if use_cache:
+        SEARCH_CACHE.set(cache_key, _copy_results(ordered_content))
     return ordered_content
 
 
 
+def get_index_stats(index: str) -> dict:
+    """Returns the documentCount and storageSize of a search index"""
+    headers, params = _search_headers_and_params()
+    resp = get_requests_session().get(os.environ['AZURE_SEARCH_ENDPOINT'] + "/indexes/" + index + "/stats", headers=headers, params=params, timeout=SEARCH_TIMEOUT)
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def aget_index_stats(index: str) -> dict:
+    """Async version of get_index_stats"""
+    headers, params = _search_headers_and_params()
+    session = get_aiohttp_session()
+    async with session.get(os.environ['AZURE_SEARCH_ENDPOINT'] + "/indexes/" + index + "/stats", headers=headers, params=params) as resp:
+        resp.raise_for_status()
+        return await resp.json()
+
+
+
 class CustomAzureSearchRetriever(BaseRetriever):
     
     indexes: List
     topK : int
     reranker_threshold : int
     sas_token : str = ""
+    use_cache : bool = True
     
     
     def _get_relevant_documents(
         self, input: str, *, run_manager: CallbackManagerForRetrieverRun
     ) -> List[Document]:
         
-        ordered_results = get_search_results(input, self.indexes, k=self.topK, reranker_threshold=self.reranker_threshold, sas_token=self.sas_token)
+        ordered_results = get_search_results(input, self.indexes, k=self.topK, reranker_threshold=self.reranker_threshold, 
+                                             sas_token=self.sas_token, use_cache=self.use_cache)
+        
+        return self._to_documents(ordered_results)
+
+    async def _aget_relevant_documents(
+        self, input: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
         
+        ordered_results = await aget_search_results(input, self.indexes, k=self.topK, reranker_threshold=self.reranker_threshold, 
+                                                    sas_token=self.sas_token, use_cache=self.use_cache)
+        
+        return self._to_documents(ordered_results)
+
+    @staticmethod
+    def _to_documents(ordered_results: dict) -> List[Document]:
         top_docs = []
         for key,value in ordered_results.items():
             location = value["location"] if value["location"] is not None else ""
@@ -395,7 +872,7 @@ def get_answer(llm: AzureChatOpenAI,
             "question": itemgetter("question")
         }
         | AGENT_DOCSEARCH_PROMPT  # Passes the 4 variables above to the prompt template
-        | llm   # Passes the finished prompt to the LLM
+        | rate_limited(llm)   # Passes the finished prompt to the LLM
         | StrOutputParser()  # converts the output (Runnable object) to the desired output (string)
     )
     
@@ -425,13 +902,14 @@ class GetDocSearchResults_Tool(BaseTool):
     k: int = 10
     reranker_th: int = 1
     sas_token: str = "" 
+    use_cache: bool = True
 
     def _run(
         self, query: str,  return_direct = False, run_manager: Optional[CallbackManagerForToolRun] = None
     ) -> str:
 
         retriever = CustomAzureSearchRetriever(indexes=self.indexes, topK=self.k, reranker_threshold=self.reranker_th, 
-                                               sas_token=self.sas_token, callback_manager=self.callbacks)
+                                               sas_token=self.sas_token, use_cache=self.use_cache, callback_manager=self.callbacks)
         results = retriever.invoke(input=query)
         
         return results
@@ -442,11 +920,8 @@ class GetDocSearchResults_Tool(BaseTool):
         """Use the tool asynchronously."""
         
         retriever = CustomAzureSearchRetriever(indexes=self.indexes, topK=self.k, reranker_threshold=self.reranker_th, 
-                                               sas_token=self.sas_token, callback_manager=self.callbacks)
-        # Please note below that running a non-async function like run_agent in a separate thread won't make it truly asynchronous. 
-        # It allows the function to be called without blocking the event loop, but it may still have synchronous behavior internally.
-        loop = asyncio.get_event_loop()
-        results = await loop.run_in_executor(ThreadPoolExecutor(), retriever.invoke, query)
+                                               sas_token=self.sas_token, use_cache=self.use_cache, callback_manager=self.callbacks)
+        results = await retriever.ainvoke(query)
         
         return results
 
@@ -469,6 +944,7 @@ class DocSearchAgent(BaseTool):
     
     def __init__(self, **data):
         super().__init__(**data)
+        self.llm = rate_limited(self.llm)
         tools = [GetDocSearchResults_Tool(indexes=self.indexes, k=self.k, reranker_th=self.reranker_th, sas_token=self.sas_token)]
 
         agent = create_openai_tools_agent(self.llm, tools, AGENT_DOCSEARCH_PROMPT)
@@ -509,6 +985,7 @@ class CSVTabularAgent(BaseTool):
 
     def __init__(self, **data):
         super().__init__(**data)
+        self.llm = rate_limited(self.llm)
         # Create the agent_executor within the __init__ method as requested
         self.agent_executor = create_csv_agent(self.llm, self.path, 
                                                agent_type="openai-tools",
@@ -554,6 +1031,7 @@ class SQLSearchAgent(BaseTool):
 
     def __init__(self, **data):
         super().__init__(**data)
+        self.llm = rate_limited(self.llm)
         db_config = self.get_db_config()
         db_url = URL.create(**db_config)
         db = SQLDatabase.from_uri(db_url)
@@ -616,6 +1094,7 @@ class ChatGPTTool(BaseTool):
 
     def __init__(self, **data):
         super().__init__(**data)
+        self.llm = rate_limited(self.llm)
 
         output_parser = StrOutputParser()
         self.chatgpt_chain = CHATGPT_PROMPT | self.llm | output_parser
@@ -681,6 +1160,7 @@ class BingSearchAgent(BaseTool):
 
     def __init__(self, **data):
         super().__init__(**data)
+        self.llm = rate_limited(self.llm)
         
         web_fetch_tool = Tool.from_function(
             func=self.fetch_web_page,
@@ -748,6 +1228,7 @@ class GetAPISearchResults_Tool(BaseTool):
 
     def __init__(self, **data):
         super().__init__(**data)
+        self.llm = rate_limited(self.llm)
         self.chain = APIChain.from_llm_and_api_docs(
             llm=self.llm,
             api_docs=self.api_spec,
@@ -758,8 +1239,7 @@ class GetAPISearchResults_Tool(BaseTool):
 
     def _run(self, query: str, return_direct = False, run_manager: Optional[CallbackManagerForToolRun] = None) -> str:
         try:
-            # Optionally sleep to avoid possible TPM rate limits
-            sleep(2)
+            # TPM/RPM limits are enforced by the process rate limiter the llm goes through
             response = self.chain.invoke(query)
         except Exception as e:
             response = str(e)  # Ensure the response is always a string
@@ -770,8 +1250,6 @@ class GetAPISearchResults_Tool(BaseTool):
         """Use the tool asynchronously."""
         loop = asyncio.get_event_loop()
         try:
-            # Optionally sleep to avoid possible TPM rate limits, handled differently in async context
-            await asyncio.sleep(2)
             # Execute the synchronous function in a separate thread
             response = await loop.run_in_executor(ThreadPoolExecutor(), self.chain.invoke, query)
         except Exception as e:
@@ -799,6 +1277,7 @@ class APISearchAgent(BaseTool):
 
     def __init__(self, **data):
         super().__init__(**data)
+        self.llm = rate_limited(self.llm)
         tools = [GetAPISearchResults_Tool(llm=self.llm,
                                           llm_search=self.llm_search,
                                           api_spec=str(self.api_spec),
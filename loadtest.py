@@ -0,0 +1,443 @@
+"""Offline load test of one bot worker (app:APP).
+
+Starts local stand-ins for Azure AI Search, Azure OpenAI (streamed chat completions) and the Bot Connector
+the replies are sent to, runs app:APP in a separate process with an in-memory chat history store in place
+of CosmosDB, then drives /api/messages with Bot Framework message activities and reports throughput and
+turn latency percentiles.
+
+    python loadtest.py --concurrency 20 --turns 400 --llm-first-token 0.8 --llm-tokens 150
+
+Nothing leaves the machine. The tiktoken encodings are used if they are cached locally, otherwise a byte level
+encoding stands in for them (the prompt token counts are then only approximate).
+"""
+import os
+import re
+import sys
+import time
+import json
+import uuid
+import base64
+import random
+import struct
+import asyncio
+import argparse
+import threading
+import subprocess
+
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+
+QUESTIONS = [
+    "What is the warranty period of the product?",
+    "How do I reset the device to factory settings?",
+    "Which documents are needed to open an account?",
+    "What are the opening hours of the support center?",
+    "How is the monthly fee calculated?",
+    "Can I transfer my contract to another person?",
+    "What happens if I miss a payment?",
+    "How do I update my contact details?",
+]
+
+EMBEDDING_DIMENSIONS = 64
+
+WORDS = ("the contract states that customers must provide a valid identity document and proof of address "
+         "before the account is opened and the fee is charged every month according to the plan").split()
+
+
+def _jitter(seconds: float, jitter: float) -> float:
+    return max(0.0, seconds * random.uniform(1 - jitter, 1 + jitter)) if seconds else 0.0
+
+
+class FakeServices:
+    """Azure AI Search, Azure OpenAI and Bot Connector stand-ins served by one local aiohttp app"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.first_reply: Dict[str, float] = {}  # incoming activity id -> time of the first message sent back
+        self.requests: Dict[str, int] = {"search": 0, "next_pages": 0, "openai": 0, "embeddings": 0, "connector": 0}
+        self.port: Optional[int] = None
+        self._loop = asyncio.new_event_loop()
+
+    def _app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/indexes/{index}/docs/search", self.search)
+        app.router.add_get("/indexes/{index}/stats", self.index_stats)
+        app.router.add_post("/openai/deployments/{deployment}/chat/completions", self.chat_completions)
+        app.router.add_post("/openai/deployments/{deployment}/embeddings", self.embeddings)
+        app.router.add_post("/v3/conversations/{conversation}/activities", self.send_activity)
+        app.router.add_post("/v3/conversations/{conversation}/activities/{activity}", self.send_activity)
+        app.router.add_put("/v3/conversations/{conversation}/activities/{activity}", self.update_activity)
+        return app
+
+    def start(self) -> None:
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            runner = web.AppRunner(self._app(), access_log=None)
+            self._loop.run_until_complete(runner.setup())
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            self._loop.run_until_complete(site.start())
+            self.port = site._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, name="fake-services", daemon=True).start()
+        ready.wait()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    # Azure AI Search
+    async def search(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        await asyncio.sleep(_jitter(self.args.search_latency, self.args.jitter))
+        if "filter" in body:
+            self.requests["next_pages"] += 1
+            titles = re.findall(r"([\w-]+\.pdf_page_\d+_chunk_\d+)", body["filter"])
+            return web.json_response({"value": [self._document(title) for title in titles]})
+        self.requests["search"] += 1
+        index = request.match_info["index"]
+        docs = []
+        for i in range(body.get("top", 10)):
+            doc = self._document(f"{index}-doc{i % 7}.pdf_page_{i}_chunk_0")
+            doc["@search.rerankerScore"] = 3.5 - i * 0.05
+            doc["@search.captions"] = [{"text": " ".join(WORDS[:20])}]
+            docs.append(doc)
+        return web.json_response({"value": docs})
+
+    def _document(self, title: str) -> dict:
+        name = title.split(".pdf")[0]
+        return {"id": uuid.uuid5(uuid.NAMESPACE_URL, title).hex, "title": title, "name": name,
+                "chunk": " ".join(random.choice(WORDS) for _ in range(self.args.chunk_words)),
+                "location": f"https://storage.local/docs/{name}.pdf"}
+
+    async def index_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"documentCount": 1000, "storageSize": 1 << 20})
+
+    # Azure OpenAI chat completions, streamed as server-sent events
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests["openai"] += 1
+        await asyncio.sleep(_jitter(self.args.llm_first_token, self.args.jitter))
+        tokens = [random.choice(WORDS) + " " for _ in range(self.args.llm_tokens)]
+        if not body.get("stream"):
+            await asyncio.sleep(self.args.llm_token_interval * len(tokens))
+            return web.json_response({
+                "id": "chatcmpl-loadtest", "object": "chat.completion", "created": int(time.time()), "model": "gpt-4",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i, token in enumerate(tokens + [None]):
+            if i:
+                await asyncio.sleep(self.args.llm_token_interval)
+            chunk = {
+                "id": "chatcmpl-loadtest", "object": "chat.completion.chunk", "created": int(time.time()), "model": "gpt-4",
+                "choices": [{"index": 0, "delta": {"role": "assistant", "content": token} if token is not None else {},
+                             "finish_reason": None if token is not None else "stop"}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    # Azure OpenAI embeddings, the same input always gets the same vector so repeated questions hit the answer cache
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests["embeddings"] += 1
+        await asyncio.sleep(_jitter(self.args.embedding_latency, self.args.jitter))
+        inputs = body["input"]  # texts or token arrays, one or a list
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        data = []
+        for i, item in enumerate(inputs):
+            rng = random.Random(json.dumps(item))
+            vector = [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+            if body.get("encoding_format") == "base64":
+                vector = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode()
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        return web.json_response({"object": "list", "data": data, "model": "text-embedding-ada-002",
+                                  "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+    # Bot Connector, receives the replies of the bot
+    async def send_activity(self, request: web.Request) -> web.Response:
+        activity = await request.json()
+        self.requests["connector"] += 1
+        reply_to = activity.get("replyToId") or request.match_info.get("activity")
+        if activity.get("type") == "message" and reply_to:
+            self.first_reply.setdefault(reply_to, time.perf_counter())
+        return web.json_response({"id": uuid.uuid4().hex})
+
+    async def update_activity(self, request: web.Request) -> web.Response:
+        self.requests["connector"] += 1
+        return web.json_response({"id": request.match_info["activity"]})
+
+
+def run_worker(args: argparse.Namespace) -> None:
+    """Runs app:APP like one gunicorn worker, with CosmosDB replaced by an in-memory container"""
+    import tiktoken
+    import tiktoken.registry
+    from common import tokenizer
+    # The chat deployment's encoding (e.g. o200k_base for gpt-4o) and the default one
+    for encoding_name in {tokenizer.encoding_name_for_model(), tokenizer.DEFAULT_ENCODING}:
+        try:
+            tiktoken.get_encoding(encoding_name)
+        except Exception:
+            print(f"tiktoken {encoding_name} is not cached locally, using a byte level encoding", file=sys.stderr)
+            encoding = tiktoken.Encoding(
+                encoding_name, pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={})
+            tokenizer._ENCODINGS[encoding_name] = encoding
+            # The embeddings client of the answer cache tokenizes its input with tiktoken directly
+            tiktoken.registry.ENCODINGS[encoding_name] = encoding
+
+    from azure.cosmos.exceptions import CosmosResourceNotFoundError
+    from common.history import CosmosDBHistoryStore
+
+    latency = args.history_latency
+    jitter = args.jitter
+
+    class InMemoryContainer:
+        def __init__(self):
+            self.items: Dict[tuple, dict] = {}
+
+        def _get(self, item, partition_key):
+            if (partition_key, item) not in self.items:
+                raise CosmosResourceNotFoundError(message="Not found")
+            return json.loads(json.dumps(self.items[(partition_key, item)]))
+
+        def read_item(self, item, partition_key):
+            time.sleep(_jitter(latency, jitter))
+            return self._get(item, partition_key)
+
+        def upsert_item(self, body):
+            time.sleep(_jitter(latency, jitter))
+            self.items[(body["user_id"], body["id"])] = body
+            return body
+
+        def delete_item(self, item, partition_key):
+            time.sleep(_jitter(latency, jitter))
+            self.items.pop((partition_key, item), None)
+
+    class AsyncInMemoryContainer:
+        def __init__(self, container: InMemoryContainer):
+            self.container = container
+
+        async def read_item(self, item, partition_key):
+            await asyncio.sleep(_jitter(latency, jitter))
+            return self.container._get(item, partition_key)
+
+    class InMemoryHistoryStore(CosmosDBHistoryStore):
+        def prepare(self) -> None:
+            with self._prepare_lock:
+                if self._container is None:
+                    self._container = InMemoryContainer()
+                    self._async_fake = AsyncInMemoryContainer(self._container)
+
+        def _async_container(self):
+            self.prepare()
+            return self._async_fake
+
+    CosmosDBHistoryStore.from_env = classmethod(lambda cls: InMemoryHistoryStore(
+        connection_string="", database="loadtest", container="loadtest",
+        cache_size=int(os.environ.get("HISTORY_CACHE_SIZE", "1000")),
+        cache_ttl=float(os.environ.get("HISTORY_CACHE_TTL", "300")),
+    ))
+
+    from app import APP
+    web.run_app(APP, host="127.0.0.1", port=args.port, print=None, access_log=None)
+
+
+def worker_env(args: argparse.Namespace, services: FakeServices) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "MICROSOFT_APP_ID": "",
+        "MICROSOFT_APP_PASSWORD": "",
+        "AZURE_SEARCH_ENDPOINT": services.url,
+        "AZURE_SEARCH_KEY": "loadtest",
+        "AZURE_SEARCH_API_VERSION": "2023-11-01",
+        "AZURE_SEARCH_INDEX": "loadtest-index",
+        "BLOB_SAS_TOKEN": "?sv=loadtest",
+        "AZURE_OPENAI_ENDPOINT": services.url,
+        "AZURE_OPENAI_API_KEY": "loadtest",
+        "AZURE_OPENAI_API_VERSION": "2024-02-01",
+        "AZURE_OPENAI_MODEL_NAME": "gpt-4",
+        "AZURE_OPENAI_EMBEDDING_MODEL_NAME": "text-embedding-ada-002",
+        "AZURE_COMOSDB_CONNECTION_STRING": "",
+        "AZURE_COSMOS_DATABASE_NAME": "loadtest",
+        "AZURE_COSMOSDB_CONTAINER_NAME": "loadtest",
+        "ANSWER_CACHE_ENABLED": "true" if args.answer_cache else "false",
+        "BOT_STREAMING_MODE": args.streaming_mode,
+        "OTEL_EXPORTER_OTLP_ENDPOINT": "",
+    })
+    if not args.search_cache:
+        env["SEARCH_CACHE_SIZE"] = "0"
+    return env
+
+
+def activity(services: FakeServices, conversation: str, user: str, text: str, channel: str) -> dict:
+    return {
+        "type": "message",
+        "id": uuid.uuid4().hex,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        "localTimestamp": time.strftime("%Y-%m-%dT%H:%M:%S.000+00:00", time.gmtime()),
+        "localTimezone": "Europe/Paris",
+        "locale": "en-US",
+        "serviceUrl": services.url,
+        "channelId": channel,
+        "from": {"id": user, "name": user},
+        "conversation": {"id": conversation},
+        "recipient": {"id": "bot", "name": "bot"},
+        "text": text,
+    }
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+async def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 120) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"The bot worker exited with code {process.returncode}")
+            try:
+                async with session.get(url + "/") as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError("The bot worker did not start")
+
+
+async def drive(args: argparse.Namespace, services: FakeServices, url: str) -> dict:
+    latencies: List[float] = []
+    first_replies: List[float] = []
+    errors: Dict[str, int] = {}
+    remaining = [args.turns]
+    connector = aiohttp.TCPConnector(limit=0)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=args.timeout)) as session:
+
+        async def user_loop(n: int):
+            turn = 0
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                # Each user has a few turns per conversation, so the history grows like in a real chat
+                conversation = f"conv-{n}-{turn // args.turns_per_conversation}"
+                question = random.choice(QUESTIONS)
+                if not args.search_cache:
+                    question += f" (ref {uuid.uuid4().hex[:8]})"
+                body = activity(services, conversation, f"user-{n}", question, args.channel)
+                started = time.perf_counter()
+                try:
+                    async with session.post(url + "/api/messages", json=body) as resp:
+                        await resp.read()
+                        if resp.status >= 400:
+                            errors[f"HTTP {resp.status}"] = errors.get(f"HTTP {resp.status}", 0) + 1
+                            continue
+                except Exception as e:
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                    continue
+                finally:
+                    turn += 1
+                latencies.append(time.perf_counter() - started)
+                first = services.first_reply.pop(body["id"], None)
+                if first is not None:
+                    first_replies.append(first - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user_loop(n) for n in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+        try:
+            async with session.get(url + "/metrics") as resp:
+                metrics = await resp.text() if resp.status == 200 else ""
+        except aiohttp.ClientError:
+            metrics = ""
+
+    return {"latencies": latencies, "first_replies": first_replies, "errors": errors, "elapsed": elapsed, "metrics": metrics}
+
+
+def stage_means(metrics: str) -> Dict[str, tuple]:
+    sums = dict(re.findall(r'stage_duration_seconds_sum\{stage="([^"]+)"\} (\S+)', metrics))
+    counts = dict(re.findall(r'stage_duration_seconds_count\{stage="([^"]+)"\} (\S+)', metrics))
+    return {stage: (int(float(counts[stage])), float(sums[stage]) / float(counts[stage]))
+            for stage in sums if float(counts.get(stage, 0))}
+
+
+def report(args: argparse.Namespace, services: FakeServices, result: dict) -> None:
+    latencies, first_replies = result["latencies"], result["first_replies"]
+    print(f"\nTurns: {len(latencies)} ok, {sum(result['errors'].values())} failed {result['errors'] or ''}")
+    print(f"Concurrency: {args.concurrency}, elapsed: {result['elapsed']:.1f}s, "
+          f"throughput: {len(latencies) / result['elapsed']:.2f} turns/s")
+    print(f"{'':<14}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, values in (("turn", latencies), ("first reply", first_replies)):
+        if values:
+            print(f"{name:<14}" + "".join(f"{percentile(values, p):>8.3f}s" for p in (50, 95, 99))
+                  + f"{max(values):>8.3f}s")
+    print(f"Backend requests: {services.requests}")
+    stages = stage_means(result["metrics"])
+    if stages:
+        print("Mean stage latency (from /metrics):")
+        for stage, (count, mean) in sorted(stages.items()):
+            print(f"  {stage:<18}{count:>8} x {mean:.4f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=10, help="simultaneous users")
+    parser.add_argument("--turns", type=int, default=200, help="total number of messages sent")
+    parser.add_argument("--turns-per-conversation", type=int, default=5)
+    parser.add_argument("--channel", default="msteams", help="channelId of the activities, drives the streaming mode")
+    parser.add_argument("--streaming-mode", default="auto", choices=["auto", "update", "chunked", "off"])
+    parser.add_argument("--search-latency", type=float, default=0.15, help="seconds per Azure AI Search request")
+    parser.add_argument("--chunk-words", type=int, default=250, help="words per search chunk")
+    parser.add_argument("--llm-first-token", type=float, default=0.8, help="seconds before the first token")
+    parser.add_argument("--llm-tokens", type=int, default=150, help="tokens per answer")
+    parser.add_argument("--llm-token-interval", type=float, default=0.02, help="seconds between streamed tokens")
+    parser.add_argument("--history-latency", type=float, default=0.02, help="seconds per Cosmos read or write")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative jitter applied to every latency")
+    parser.add_argument("--search-cache", action="store_true", help="repeat questions and keep the search cache on")
+    parser.add_argument("--answer-cache", action="store_true",
+                        help="keep the semantic answer cache on (it only hits repeated questions, see --search-cache)")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embedding request")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds before a turn is counted as failed")
+    parser.add_argument("--port", type=int, default=3979, help="port of the bot worker")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    services = FakeServices(args)
+    services.start()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker"] + sys.argv[1:],
+                               env=worker_env(args, services), cwd=os.path.dirname(os.path.abspath(__file__)))
+    url = f"http://127.0.0.1:{args.port}"
+    try:
+        asyncio.run(wait_until_up(url, process))
+        result = asyncio.run(drive(args, services, url))
+    finally:
+        process.terminate()
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    report(args, services, result)
+
+
+if __name__ == "__main__":
+    main()
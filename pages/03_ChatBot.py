@@ -1,16 +1,12 @@
 import streamlit as st
 import os
 import time
+import atexit
 
-from operator import itemgetter
-from langchain_openai import AzureChatOpenAI
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.output_parsers import StrOutputParser
-from langchain_community.chat_message_histories import CosmosDBChatMessageHistory
-from langchain_core.runnables import ConfigurableFieldSpec
-
-from common.utils import CustomAzureSearchRetriever
-from common.prompts import WELCOME_MESSAGE, DOCSEARCH_PROMPT
+from common.chains import CHAIN_REGISTRY, DOCSEARCH_CHAIN, build_docsearch_chain
+from common.history import CosmosDBHistoryStore
+from common.semantic_cache import SemanticAnswerCache
+from common.prompts import WELCOME_MESSAGE
 from dotenv import load_dotenv
 from uuid import uuid4
 
@@ -20,17 +16,20 @@ load_dotenv()
 AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME")
 os.environ["OPENAI_API_VERSION"] = os.environ.get("AZURE_OPENAI_API_VERSION")
 
+# One history store per process, shared by every Streamlit session and rerun
+@st.cache_resource
+def get_history_store():
+    store = CosmosDBHistoryStore.from_env()
+    store.prepare()
+    atexit.register(store.close)
+    return store
+
 def get_session_history(session_id, user_id):
-    cosmos = CosmosDBChatMessageHistory(
-        cosmos_endpoint=os.environ['AZURE_COSMOSDB_ENDPOINT'],
-        cosmos_database=os.environ['AZURE_COSMOS_DATABASE_NAME'],
-        cosmos_container=os.environ['AZURE_COSMOSDB_CONTAINER_NAME'],
-        connection_string=os.environ['AZURE_COMOSDB_CONNECTION_STRING'],
-        session_id=session_id,
-        user_id=user_id
-    )
-    cosmos.prepare_cosmos()
-    return cosmos
+    return get_history_store().get_session_history(session_id, user_id)
+
+# The chain lives in the process-wide registry, so Streamlit reruns reuse it instead of rebuilding it
+CHAIN_REGISTRY.register(DOCSEARCH_CHAIN, lambda: build_docsearch_chain(get_session_history, model_name=AZURE_OPENAI_MODEL_NAME,
+                                                                     answer_cache=SemanticAnswerCache.from_env(indexes=[os.environ['AZURE_SEARCH_INDEX']])))
 
 st.title("Noventiq Smartbot")
 
@@ -59,52 +58,7 @@ if prompt := st.chat_input("What is up?"):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
-        llm = AzureChatOpenAI(deployment_name=AZURE_OPENAI_MODEL_NAME, 
-                              temperature=0, 
-                              max_tokens=1500, 
-                              streaming=True)
-
-        retriever = CustomAzureSearchRetriever(
-            indexes=[os.environ['AZURE_SEARCH_INDEX']], 
-            topK=20, 
-            reranker_threshold=1, 
-            sas_token=os.environ['BLOB_SAS_TOKEN']
-        )
-
-        chain = (
-            {
-                "context": itemgetter("question") | retriever, 
-                "question": itemgetter("question"), 
-                "history": itemgetter("history")
-            } 
-                | DOCSEARCH_PROMPT 
-                | llm
-            )
-        
-        chain_with_history = RunnableWithMessageHistory(
-            chain,
-            get_session_history,
-            input_messages_key="question",
-            history_messages_key="history",
-            history_factory_config=[
-                ConfigurableFieldSpec(
-                    id="user_id",
-                    annotation=str,
-                    name="User ID",
-                    description="Unique identifier for the user.",
-                    default="",
-                    is_shared=True,
-                ),
-                ConfigurableFieldSpec(
-                    id="session_id",
-                    annotation=str,
-                    name="Session ID",
-                    description="Unique identifier for the conversation.",
-                    default="",
-                    is_shared=True,
-                ),
-            ],
-        ) | StrOutputParser()
+        chain_with_history = CHAIN_REGISTRY.get(DOCSEARCH_CHAIN)
 
         config={"configurable": {"session_id": st.session_state.session_id, "user_id": st.session_state.user_id}}
 
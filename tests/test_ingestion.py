@@ -0,0 +1,151 @@
+import json
+
+import pytest
+
+from common import ingestion
+from common.ingestion import DocumentLog, chunk_key, chunk_title, content_hash, index_pdf
+
+
+# Short chunks, so every paragraph of the test pages is a chunk
+CHUNKING = {"chunk_size": 40, "chunk_overlap": 0}
+
+
+class FakeContainer:
+    def __init__(self):
+        self.items = {}
+
+    def read_item(self, item, partition_key):
+        if item not in self.items:
+            raise ingestion.CosmosResourceNotFoundError(message="Not found")
+        return json.loads(json.dumps(self.items[item]))
+
+    def upsert_item(self, body):
+        self.items[body["id"]] = json.loads(json.dumps(body))
+
+
+class FakePipeline:
+    def __init__(self, fail_flush=False):
+        self.fail_flush = fail_flush
+        self.added = []
+        self.deleted = []
+        self.discarded = False
+
+    def add(self, document):
+        self.added.append(document["title"])
+
+    def delete(self, keys):
+        self.deleted.extend(keys)
+
+    def flush(self):
+        if self.fail_flush:
+            raise RuntimeError("index unavailable")
+        return {"chunks": len(self.added), "deleted": len(self.deleted)}
+
+    def discard(self):
+        self.discarded = True
+
+
+@pytest.fixture(autouse=True)
+def pages_from_json(monkeypatch):
+    # The test "PDFs" are JSON lists of page texts
+    def iter_pdf_pages(file, **kwargs):
+        with open(file) as f:
+            for page_num, text in enumerate(json.load(f)):
+                yield page_num, 0, text
+
+    monkeypatch.setattr(ingestion, "iter_pdf_pages", iter_pdf_pages)
+
+
+@pytest.fixture
+def document_log():
+    return DocumentLog(FakeContainer())
+
+
+def write_pdf(tmp_path, pages):
+    path = tmp_path / "manual.pdf"
+    path.write_text(json.dumps(pages))
+    return str(path)
+
+
+def run(path, document_log, pipeline=None):
+    pipeline = pipeline or FakePipeline()
+    report = index_pdf(path, "index", location="https://blob/manual.pdf", pipeline=pipeline,
+                       document_log=document_log, **CHUNKING)
+    return report, pipeline
+
+
+def entry(document_log):
+    return document_log.get(DocumentLog.document_id("manual"))
+
+
+PAGES = ["The first paragraph of page one.\n\nThe second paragraph of page one.\n\nThe last paragraph of page one.",
+         "The first paragraph of page two.\n\nThe second paragraph of page two.",
+         "The only paragraph of page three."]
+
+
+def test_unchanged_file_is_skipped(tmp_path, document_log):
+    path = write_pdf(tmp_path, PAGES)
+    first, pipeline = run(path, document_log)
+    assert first["indexed"] == len(pipeline.added) == 6
+    assert entry(document_log)["status"] == "indexed"
+
+    second, pipeline = run(path, document_log)
+    assert second["skipped"] and second["unchanged"] == first["indexed"]
+    assert pipeline.added == [] and pipeline.deleted == []
+
+
+def test_only_the_changed_chunk_is_embedded_again(tmp_path, document_log):
+    first, _ = run(write_pdf(tmp_path, PAGES), document_log)
+    changed = [PAGES[0], PAGES[1].replace("second", "next"), PAGES[2]]
+
+    report, pipeline = run(write_pdf(tmp_path, changed), document_log)
+    assert pipeline.added == [chunk_title("manual", 2, 1)]
+    assert pipeline.deleted == []
+    assert report["unchanged"] == first["indexed"] - 1
+
+
+def test_removed_chunks_and_pages_are_deleted(tmp_path, document_log):
+    run(write_pdf(tmp_path, PAGES), document_log)
+    page_one_chunks = len(entry(document_log)["chunk_digests"]["1"])
+    shrunk = [PAGES[0].rsplit("\n\n", 1)[0], PAGES[1]]
+
+    report, pipeline = run(write_pdf(tmp_path, shrunk), document_log)
+    assert set(pipeline.deleted) == {chunk_key(chunk_title("manual", 1, page_one_chunks - 1)),
+                                     chunk_key(chunk_title("manual", 3, 0))}
+    assert report["deleted"] == 2
+    assert entry(document_log)["pages"] == 2
+    assert "3" not in entry(document_log)["chunk_digests"]
+
+
+def test_failed_run_keeps_the_previous_digests(tmp_path, document_log):
+    run(write_pdf(tmp_path, PAGES), document_log)
+    before = entry(document_log)["chunk_digests"]
+
+    pipeline = FakePipeline(fail_flush=True)
+    with pytest.raises(RuntimeError):
+        run(write_pdf(tmp_path, [text.upper() for text in PAGES]), document_log, pipeline)
+    assert pipeline.discarded
+    assert entry(document_log)["status"] == "failed"
+    assert entry(document_log)["chunk_digests"] == before
+
+    # The next run compares with the digests of the last successful one
+    report, pipeline = run(write_pdf(tmp_path, PAGES), document_log)
+    assert pipeline.added == [] and report["unchanged"] == sum(map(len, before.values()))
+
+
+def test_legacy_chunk_hashes_are_read(tmp_path, document_log):
+    run(write_pdf(tmp_path, PAGES), document_log)
+    legacy = entry(document_log)
+    digests = legacy.pop("chunk_digests")
+    titles = {chunk_title("manual", int(page), chunk_num): digest
+              for page, page_digests in digests.items() for chunk_num, digest in enumerate(page_digests)}
+    # Entries used to keep the 32 character hash of every chunk, by title
+    legacy["chunk_hashes"] = {title: digest + content_hash(title)[:16] for title, digest in titles.items()}
+    legacy["content_hash"] = "changed"
+    document_log.container.upsert_item(legacy)
+
+    report, pipeline = run(write_pdf(tmp_path, PAGES), document_log)
+    assert pipeline.added == [] and pipeline.deleted == []
+    assert report["unchanged"] == len(titles)
+    assert entry(document_log)["chunk_digests"] == digests
+    assert "chunk_hashes" not in entry(document_log)
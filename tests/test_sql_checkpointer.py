@@ -0,0 +1,127 @@
+import copy
+import json
+import asyncio
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import create_engine, event
+
+from common.sql_checkpointer import CheckpointBatchWriter, RetentionPolicy, SQLAlchemyCheckpointSaver
+
+
+@pytest.fixture
+def saver(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'checkpoints.db'}")
+    writer = CheckpointBatchWriter(engine, max_rows=16, max_delay=0.05)
+    saver = SQLAlchemyCheckpointSaver(engine, writer=writer)
+    saver.setup()
+    yield saver
+    writer.close()
+
+
+def put(saver, thread_id, ts):
+    return saver.put({"configurable": {"thread_id": thread_id}}, {"v": 1, "ts": ts})
+
+
+def test_cancelled_aput_does_not_stop_the_writer(saver):
+    async def main():
+        task = asyncio.ensure_future(saver.aput({"configurable": {"thread_id": "t"}}, {"v": 1, "ts": "ts1"}))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.wait_for(saver.aput({"configurable": {"thread_id": "t"}}, {"v": 1, "ts": "ts2"}), timeout=5)
+
+    asyncio.run(main())
+    assert saver.writer._thread.is_alive()
+    assert saver.writer.submit(SQLAlchemyCheckpointSaver._row(
+        {"configurable": {"thread_id": "t"}}, {"ts": "ts3"}, b"")).result(timeout=5) is None
+    assert [item["configurable"]["thread_ts"] for item in saver.list({"configurable": {"thread_id": "t"}})] == ["ts3", "ts2"]
+
+
+def test_failed_batch_only_fails_the_faulty_rows(saver):
+    put(saver, "t", "ts1")
+    inserts = []
+    event.listen(saver.engine, "before_cursor_execute", lambda *args: inserts.append(args[2]) if args[2].startswith("INSERT") else None)
+    rows = [SQLAlchemyCheckpointSaver._row({"configurable": {"thread_id": "t"}}, {"ts": ts}, b"x") for ts in ("ts2", "ts1", "ts3")]
+    futures = [saver.writer.submit(row) for row in rows]
+
+    assert futures[0].result(timeout=5) is None
+    assert futures[2].result(timeout=5) is None
+    with pytest.raises(Exception):
+        futures[1].result(timeout=5)
+    # One multi-row insert, then one insert per row
+    assert len(inserts) == 4
+    assert put(saver, "t", "ts4")["configurable"]["thread_ts"] == "ts4"
+
+
+def test_list_rejects_an_empty_page_size(saver):
+    config = {"configurable": {"thread_id": "t"}}
+    with pytest.raises(ValueError):
+        saver.list(config, page_size=0)
+    with pytest.raises(ValueError):
+        saver.alist(config, page_size=0)
+
+
+def test_list_items_behave_like_plain_dicts(saver):
+    put(saver, "t", "ts1")
+    expected = {"v": 1, "ts": "ts1"}
+
+    def item():
+        return next(iter(saver.list({"configurable": {"thread_id": "t"}})))
+
+    assert "checkpoint" in item() and len(item()) == 3
+    assert dict(item())["checkpoint"] == expected
+    assert json.loads(json.dumps(item()))["checkpoint"] == expected
+    assert copy.copy(item())["checkpoint"] == expected
+    assert copy.deepcopy(item())["checkpoint"] == expected
+    assert "checkpoint" in item().keys()
+    assert expected in item().values()
+
+
+def days_ago(days, minutes=0):
+    return (datetime.now(timezone.utc) - timedelta(days=days, minutes=minutes)).isoformat()
+
+
+def put_history(saver, thread_id, timestamps):
+    for ts in sorted(timestamps):
+        put(saver, thread_id, ts)
+    return sorted(timestamps, reverse=True)
+
+
+def thread_ts(saver, thread_id):
+    return [item["configurable"]["thread_ts"] for item in saver.list({"configurable": {"thread_id": thread_id}})]
+
+
+def test_compaction_keeps_the_last_checkpoints_of_each_thread(saver):
+    long = put_history(saver, "long", [days_ago(0, minutes) for minutes in range(7)])
+    short = put_history(saver, "short", [days_ago(0, minutes) for minutes in range(2)])
+
+    # Batches smaller than the rows to delete, so the deletion takes several transactions
+    report = saver.compact(RetentionPolicy(keep_last=3, max_idle_days=0, batch_size=2))
+    assert thread_ts(saver, "long") == long[:3]
+    assert thread_ts(saver, "short") == short
+    assert report["rows_deleted"] == 4 and report["threads_trimmed"] == 1
+
+
+def test_compaction_drops_the_threads_idle_for_too_long(saver):
+    idle = put_history(saver, "idle", [days_ago(40, minutes) for minutes in range(3)])
+    recent = put_history(saver, "recent", [days_ago(40), days_ago(1)])
+
+    report = saver.compact(RetentionPolicy(keep_last=0, max_idle_days=30, batch_size=2))
+    assert thread_ts(saver, "idle") == []
+    # Only whole threads expire, the old checkpoints of an active thread stay
+    assert thread_ts(saver, "recent") == recent
+    assert report["rows_deleted"] == len(idle) and report["threads_expired"] == 1
+
+
+def test_compaction_never_deletes_the_latest_checkpoint_of_an_active_thread(saver):
+    latest = {}
+    for thread_id in ("a", "b", "c"):
+        latest[thread_id] = put_history(saver, thread_id, [days_ago(0, minutes) for minutes in range(5)])[0]
+
+    saver.compact(RetentionPolicy(keep_last=1, max_idle_days=30, batch_size=1))
+    for thread_id, ts in latest.items():
+        assert thread_ts(saver, thread_id) == [ts]
+        assert saver.get({"configurable": {"thread_id": thread_id}})["ts"] == ts